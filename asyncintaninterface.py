@@ -0,0 +1,221 @@
+import asyncio
+from interfaceutils import *
+from interfacebase import IntanInterfaceBase
+from commandclient import AsyncCommandClient
+import numpy as np
+
+class AsyncIntanInterface(IntanInterfaceBase):
+    """asyncio version of IntanInterface. All socket I/O and waits are awaitable and the
+    CPU-bound feature computation runs in the loop's default executor, so any number of
+    arms/RHX servers can be served from one event loop with asyncio.gather.
+
+    Create with `interface = await AsyncIntanInterface.connect(cmdAddrPort, waveAddrPort)`.
+    """
+    def __init__(self, debug=False):
+        super().__init__(debug)
+        self.__pending = bytearray()
+
+    @classmethod
+    async def connect(cls, cmdAddrPort, waveAddrPort, timeout=5, debug=False):
+        self = cls(debug=debug)
+
+        # Connect to TCP command server - default home IP address at port 5000.
+        print('Connecting to TCP command server...')
+        try:
+            self._debugOut(f"Attempting to connect to {cmdAddrPort}. Timeout = {timeout}s")
+            self.cmdReader, self.cmdWriter = await asyncio.wait_for(asyncio.open_connection(*cmdAddrPort), timeout)
+        except asyncio.TimeoutError:
+            print("Connection timeout. Please make sure TCP command port is connected on Intan")
+            exit(1)
+        except Exception as e:
+            print(f"Some error occured: {e}.\nPlease check your TCP command port on Intan.")
+            exit(1)
+        print(f"Connected to {cmdAddrPort[0]}:{cmdAddrPort[1]}")
+        self.commands = AsyncCommandClient(self.cmdReader, self.cmdWriter, timeout)
+
+        # Connect to TCP waveform server - default home IP address at port 5001.
+        print('Connecting to TCP waveform server...')
+        try:
+            self._debugOut(f"Attempting to connect to {waveAddrPort}. Timeout = {timeout}s")
+            self.waveReader, self.waveWriter = await asyncio.wait_for(asyncio.open_connection(*waveAddrPort), timeout)
+        except asyncio.TimeoutError:
+            print("Connection timeout. Please make sure TCP waveform port is connected on Intan.")
+            exit(1)
+        except Exception as e:
+            print(f"Some error occured: {e}.\nPlease check your TCP waveform port on Intan.")
+            exit(1)
+        print(f"Connected to {waveAddrPort[0]}:{waveAddrPort[1]}")
+        return self
+
+    async def close(self):
+        for writer in (self.cmdWriter, self.waveWriter):
+            writer.close()
+            await writer.wait_closed()
+
+    async def setup(self, **kwargs):
+        """Same options as IntanInterface.setup (channel, recordtime, focusfreq, feature,
+        featureoptions, decimation, profile, maxage, validatetime).
+        """
+        recordtime, channel = self.applySetup(kwargs)
+
+        ## Setup Intan Software
+        # Query runmode and sample rate from RHX software in one round trip.
+        try:
+            replies = await self.commands.query('runmode', 'sampleratehertz')
+            sampleRate = float(replies['sampleratehertz'])
+        except (CommandError, ValueError):
+            raise GetSampleRateFailure(
+                'Unable to get sample rate from server.'
+            )
+
+        # If controller is running, stop it (returns once RHX reports Stop).
+        if replies['runmode'] != "Stop":
+            self._debugOut("Stopping controller...")
+            await self.commands.setRunMode('stop')
+
+        self.timestep = 1 / sampleRate
+
+        # Build the feature extractor (e.g. the focus-scale wavelet kernel) once
+        self.buildFeatureEngine()
+
+        # Activate Channel
+        await self.activateChannel()
+
+        # Calibrate electrode, unless a saved profile still matches a short resting window
+        profile = kwargs.get('profile')
+        name = None if profile is True else profile
+        saved = self.loadProfile(name, kwargs.get('maxage', 24 * 3600)) if profile else None
+        if saved is not None and await self.validateProfile(saved, kwargs.get('validatetime', 0.5)):
+            self.applyProfile(saved)
+            print("Using saved calibration. Threshold for Flexing classification: ", self.flexThresh)
+        else:
+            await self.calibrate(recordtime=recordtime)
+            if profile:
+                self.saveProfile(name)
+
+        self._setupLock = True
+
+    async def calibrate(self, **kwargs):
+        """Time for calibration **per** action, see IntanInterface.calibrate.
+        """
+        recordtime = self.applyCalibrate(kwargs)
+
+        calibrations = {}
+        modes = ["Resting", "Flexing"]
+        for mode in modes:
+            print(f"Running {mode} calibration for {recordtime} seconds. Please begin {mode}.")
+            print("Beginning in 5 seconds...")
+            await asyncio.sleep(1)
+            for i in range(4, 0, -1):
+                print(f"{i}...")
+                await asyncio.sleep(1)
+            print("Calibrating...")
+
+            # run for `recordtime` amount of seconds
+            await self.record(recordtime)
+            print("Finished.")
+            await asyncio.sleep(2)
+
+            # Read waveform and compute mean power at object's freq
+            lost = self.continuity.lostSamples
+            timestamps, data = await self.readWaveform(recordtime)
+            self.warnLost(self.continuity.lostSamples - lost, mode)
+            mean = await self.computeFocusPower(data)
+            self._debugOut(f"Mean {mode} Power: ", mean)
+            calibrations[mode] = mean
+
+        self.setThreshold(calibrations)
+
+    async def validateProfile(self, profile, recordtime=0.5, tolerance=0.5):
+        """See IntanInterface.validateProfile.
+        """
+        print(f"Checking saved calibration: please stay resting for {recordtime} seconds...")
+        timestamps, data = await self.recordRead(recordtime)
+        return self.matchesProfile(await self.computeFocusPower(data), profile, tolerance)
+
+    async def detectFlexing(self, timeframe=1):
+        timestamps, data = await self.recordRead(timeframe)
+
+        # Comput mean power at object's freq
+        mean = await self.computeFocusPower(data)
+        self._debugOut(f"Sample Mean Power: {mean}")
+
+        return mean > self.flexThresh
+
+    async def recordRead(self, recordtime):
+        await self.record(recordtime)
+        return await self.readWaveform(recordtime)
+
+    async def record(self, recordtime):
+        self._debugOut("Start recording")
+        self.continuity.restart()
+        await self.commands.setRunMode('run')
+        await asyncio.sleep(recordtime)
+        self._debugOut("Stop recording")
+        await self.commands.setRunMode('stop')
+
+    async def readWaveform(self, recordtime, idle=0.1):
+        """Reads every whole block that arrives until the stream is quiet for `idle` seconds.
+        A partial trailing block is kept for the next read.
+        """
+        blockSize = waveformBytesPerBlock(self.frames_per_block, len(self._channels))
+        while len(self.__pending) < blockSize:
+            await self.__readWave(None)
+        while await self.__readWave(idle):
+            pass
+
+        wholeBytes = len(self.__pending) - len(self.__pending) % blockSize
+        rawData = bytes(self.__pending[:wholeBytes])
+        del self.__pending[:wholeBytes]
+        self._debugOut("Raw data length:", len(rawData))
+        self._debugOut("# Blocks:", wholeBytes // blockSize)
+        frames, samples = decodeWaveformBlocks(rawData, self.timestep, self.frames_per_block, self._numChannels,
+                                               raw=True)
+        lost = self.continuity.update(frames)
+        if lost:
+            self._debugOut(f"{lost} samples lost in this read ({self.continuity.gaps} gaps so far)")
+        return frames * self.timestep, toMicroVolts(samples, np.float64)
+
+    async def computeFocusPower(self, data):
+        """The selected feature of the window (see IntanInterface.computeFocusPower), computed in
+        the default executor so the event loop keeps serving other arms.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.featurePower, data)
+
+    async def activateChannel(self, override=False):
+        # Clear all outputs, then activate channel(s) to switch to this object's channel(s).
+        # Sent as one batch; returns once RHX has processed all of them.
+        commands = self.channelCommands(override)
+        self._debugOut("Clearing All Data Outputs")
+        await self.commands.execute(*commands)
+
+        for channel in self._channels:
+            print(f"Activated channel A-%03.f" % channel)
+
+    async def __readWave(self, timeout):
+        # Returns False if nothing arrived within `timeout` seconds (None = wait forever)
+        try:
+            chunk = await asyncio.wait_for(self.waveReader.read(self.buffersize), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if not chunk:
+            raise WaveformConnectionClosed('Waveform socket was closed by the server.')
+        self.__pending += chunk
+        return True
+
+async def main():
+    # Both arms from one event loop, no processes
+    arms = {
+        'right': await AsyncIntanInterface.connect(('127.0.0.1', 5000), ('127.0.0.1', 5001)),
+        'left': await AsyncIntanInterface.connect(('127.0.0.1', 5002), ('127.0.0.1', 5003)),
+    }
+    await arms['right'].setup(recordtime=3, channel=23)
+    await arms['left'].setup(recordtime=3, channel=23)
+
+    for i in range(0, 80):
+        measures = await asyncio.gather(*[interface.detectFlexing(timeframe=0.25) for interface in arms.values()])
+        print(dict(zip(arms.keys(), measures)))
+
+if __name__ == "__main__":
+    asyncio.run(main())
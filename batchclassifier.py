@@ -0,0 +1,189 @@
+#########################################
+#   Batch Classifier
+#
+#   Offline version of IntanInterface.calibrate + detectFlexing for whole recordings: a long
+#   signal is cut into windows (length and hop in seconds), the feature (by default the
+#   focus-scale wavelet power) of every window is computed in one vectorized call, and the windows are classified against
+#   any number of threshRatio values at once. Recordings or parameter sets are spread over a
+#   process pool.
+#
+
+import os
+import multiprocessing as mp
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from featureengine import Decimator, makeExtractor, FEATURE_EXTRACTORS
+
+DEFAULT_SCALES = np.arange(1, 128, 4)
+
+
+def windowPowers(data, engine, window, hop, mode='window', chunkBytes=64 * 2 ** 20, decimator=None):
+    """engine.meanPower (e.g. mean |coef|) of every window of `window` samples, one every `hop`
+    samples.
+
+    mode='window': each window is transformed on its own, exactly what detectFlexing computes
+        for a recorded window (edge effects included).
+    mode='stream': windows of one continuous transform, what streaming with a hop computes.
+    decimator: featureengine.Decimator applied before the engine (built for the decimated
+        rate); window and hop stay in input samples.
+
+    Returns: (starts, powers) with the first sample of each window.
+    """
+    data = np.asarray(data)
+    if mode == 'stream':
+        # Window sums over one transform of the whole signal (what SlidingPower emits)
+        starts = np.arange(0, data.size - window + 1, hop)
+        q = 1 if decimator is None else decimator.factor
+        signal = data if decimator is None else decimator.decimate(data)
+        cumulative = np.concatenate(([0], np.cumsum(engine.samplePowers(signal))))
+        # Window [start, start + window) in feature samples
+        first, length = -(-starts // q), round(window / q)
+        keep = first + length <= signal.size
+        starts, first = starts[keep], first[keep]
+        return starts, engine.finish((cumulative[first + length] - cumulative[first]) / length)
+    if mode != 'window':
+        raise ValueError("mode must be 'window' or 'stream'")
+
+    windows = sliding_window_view(data, window)[::hop]
+    starts = np.arange(windows.shape[0]) * hop
+    # Bound the (windows, samples) FFT work arrays
+    perChunk = max(1, chunkBytes // (16 * 2 * window))
+    def chunkPower(chunk):
+        return engine.meanPower(chunk if decimator is None else decimator.decimate(chunk))
+    powers = np.concatenate([chunkPower(windows[i:i + perChunk])
+                             for i in range(0, windows.shape[0], perChunk)]) if windows.shape[0] else np.empty(0)
+    return starts, powers
+
+
+def thresholds(restingPower, flexingPower, ratios):
+    """flexThresh for every threshRatio, as IntanInterface.calibrate computes it.
+    """
+    return restingPower + (flexingPower - restingPower) * np.asarray(ratios, dtype=float)
+
+
+def classify(powers, flexThresh):
+    """Decisions for every window against every threshold: (thresholds, windows) bools.
+    """
+    return np.asarray(powers)[None, :] > np.atleast_1d(flexThresh)[:, None]
+
+
+def windowLabels(starts, window, sampleRate, flexingIntervals):
+    """Ground truth per window: flexing if the window's center lies in one of the
+    (start, end) intervals in seconds.
+    """
+    centers = (np.asarray(starts) + window / 2) / sampleRate
+    labels = np.zeros(centers.shape, dtype=bool)
+    for start, end in flexingIntervals:
+        labels |= (centers >= start) & (centers < end)
+    return labels
+
+
+def loadSignal(source, channel):
+    """(data, sampleRate) from an .rhd path, a stream capture directory or an (array,
+    sampleRate) pair.
+    """
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            from streamcapture import CaptureReader
+            reader = CaptureReader(source)
+        else:
+            from rhdreader import RHDReader
+            reader = RHDReader(source)
+        return np.asarray(reader.amplifier(channel)), reader.sampleRate
+    data, sampleRate = source
+    return np.asarray(data), sampleRate
+
+
+def evaluate(source, channel=0, resting=(0, 1), flexing=(1, 2), test=None, window=0.25, hop=None,
+             ratios=(0.25, 0.5, 0.75), flexingIntervals=(), wavelet='mexh', scales=DEFAULT_SCALES,
+             focusfreq=25, mode='window', decimation=1, feature='cwt', featureOptions=None):
+    """Calibrates on the resting/flexing (start, end) segments (seconds), then classifies every
+    window of the `test` segment (default: whole signal) for every threshRatio. feature,
+    featureOptions, decimation: as on IntanInterface.
+
+    Returns a dict with the calibration means, thresholds, decisions per ratio and, when
+    flexingIntervals are given, the accuracy per ratio.
+    """
+    data, sampleRate = loadSignal(source, channel)
+    decimator = Decimator(decimation) if decimation > 1 else None
+    engine = makeExtractor(feature, sampleRate, decimation, wavelet=wavelet, scale=scales[focusfreq],
+                           **(featureOptions or {}))
+    hop = window if hop is None else hop
+    windowSamples, hopSamples = int(round(window * sampleRate)), int(round(hop * sampleRate))
+
+    def segment(bounds):
+        return data[int(round(bounds[0] * sampleRate)):int(round(bounds[1] * sampleRate))]
+
+    def power(data):
+        return engine.meanPower(data if decimator is None else decimator.decimate(data))
+
+    restingPower = power(segment(resting))
+    flexingPower = power(segment(flexing))
+    flexThresh = thresholds(restingPower, flexingPower, ratios)
+
+    test = (0, data.size / sampleRate) if test is None else test
+    offset = int(round(test[0] * sampleRate))
+    starts, powers = windowPowers(segment(test), engine, windowSamples, hopSamples, mode, decimator=decimator)
+    decisions = classify(powers, flexThresh)
+
+    result = {
+        'source': source if isinstance(source, str) else '<array>',
+        'channel': channel, 'window': window, 'hop': hop, 'mode': mode,
+        'feature': feature, 'wavelet': wavelet, 'focusfreq': focusfreq, 'decimation': decimation,
+        'restingPower': restingPower, 'flexingPower': flexingPower,
+        'ratios': list(ratios), 'flexThresh': flexThresh,
+        'windowStarts': (starts + offset) / sampleRate, 'powers': powers, 'decisions': decisions,
+    }
+    if flexingIntervals:
+        labels = windowLabels(starts + offset, windowSamples, sampleRate, flexingIntervals)
+        result['labels'] = labels
+        result['accuracy'] = np.mean(decisions == labels[None, :], axis=1)
+    return result
+
+
+def _evaluateJob(job):
+    return evaluate(**job)
+
+
+def evaluateMany(jobs, processes=None):
+    """Runs evaluate(**job) for every job dict on a process pool (one job per task), keeping
+    the order of `jobs`.
+    """
+    jobs = list(jobs)
+    if processes == 1 or len(jobs) <= 1:
+        return [evaluate(**job) for job in jobs]
+    with mp.Pool(processes) as pool:
+        return pool.map(_evaluateJob, jobs, chunksize=1)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Classify every window of a recording offline.')
+    parser.add_argument('recordings', nargs='+', help='.rhd files or stream capture directories')
+    parser.add_argument('--channel', type=int, default=0, help='RHX channel number on port A (23 = A-023)')
+    parser.add_argument('--resting', type=float, nargs=2, required=True, metavar=('START', 'END'))
+    parser.add_argument('--flexing', type=float, nargs=2, required=True, metavar=('START', 'END'))
+    parser.add_argument('--test', type=float, nargs=2, metavar=('START', 'END'))
+    parser.add_argument('--window', type=float, default=0.25)
+    parser.add_argument('--hop', type=float)
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.25, 0.5, 0.75])
+    parser.add_argument('--flex-interval', type=float, nargs=2, action='append', default=[],
+                        metavar=('START', 'END'), help='Labeled flexing interval (repeatable)')
+    parser.add_argument('--stream', action='store_true', help='Continuous-transform windows')
+    parser.add_argument('--feature', default='cwt', choices=FEATURE_EXTRACTORS)
+    parser.add_argument('--decimation', type=int, default=1, help='Decimate by this factor before the feature')
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    jobs = [dict(source=path, channel=args.channel, resting=args.resting, flexing=args.flexing, test=args.test,
+                 window=args.window, hop=args.hop, ratios=args.ratios, flexingIntervals=args.flex_interval,
+                 mode='stream' if args.stream else 'window', decimation=args.decimation,
+                 feature=args.feature) for path in args.recordings]
+    for result in evaluateMany(jobs, args.processes):
+        print(f"{result['source']}: resting {result['restingPower']:.5f}, flexing {result['flexingPower']:.5f}")
+        for i, ratio in enumerate(result['ratios']):
+            line = f"  threshRatio {ratio:.0%}: threshold {result['flexThresh'][i]:.5f}"
+            if 'accuracy' in result:
+                correct = int(round(result['accuracy'][i] * len(result['labels'])))
+                line += f", {correct}/{len(result['labels'])} correct"
+            print(line)
@@ -0,0 +1,298 @@
+#########################################
+#   Benchmark Suite
+#
+#   Measures the hot paths of the interface and writes the results as JSON:
+#     decode    waveform block decoding (blocks/s), vectorized and per-frame reference
+#     features  computeCWT (all scales), computeFocusPower and the O(n) feature extractors per
+#               window size; the batched multi-channel CWT per channel count
+#     detect    detectFlexing end-to-end against a local RHXSimulator (recorded, streamed,
+#               sliding window)
+#     arms      two-arm control loop throughput (arm processes -> queue -> control output)
+#
+#   Usage:
+#     python benchmark.py run --out before.json
+#     python benchmark.py compare before.json after.json --threshold 0.1
+#
+#   compare exits with status 1 if any shared result got worse by more than the threshold.
+#
+
+import os
+import sys
+import json
+import queue
+import platform
+import multiprocessing as mp
+import numpy as np
+import pywt
+from time import perf_counter, monotonic, sleep, strftime
+from interfaceutils import MAGIC_NUMBER, waveformBlockDtype, decodeWaveformBlocks, decodeWaveformBlocksReference
+from featureengine import FocusScaleCWT, makeExtractor, FEATURE_EXTRACTORS
+
+WINDOWS = (0.2, 0.25, 0.5, 1)
+SCALES = np.arange(1, 128, 4)
+
+
+def result(name, value, unit, higherIsBetter):
+    return {'name': name, 'value': float(value), 'unit': unit, 'higherIsBetter': higherIsBetter}
+
+
+def latencyResults(name, times):
+    times = np.asarray(times) * 1e3
+    return [result(f"{name}.mean", np.mean(times), 'ms', False),
+            result(f"{name}.p50", np.percentile(times, 50), 'ms', False),
+            result(f"{name}.p95", np.percentile(times, 95), 'ms', False)]
+
+
+def timeit(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return times
+
+
+def randomBlocks(numBlocks, numChannels=1, framesPerBlock=128, seed=0):
+    """Raw waveform bytes as RHX sends them (random samples, consecutive timestamps).
+    """
+    rng = np.random.default_rng(seed)
+    blocks = np.zeros(numBlocks, dtype=waveformBlockDtype(framesPerBlock, numChannels))
+    blocks['magic'] = MAGIC_NUMBER
+    blocks['frames']['timestamp'] = np.arange(numBlocks * framesPerBlock).reshape(numBlocks, -1)
+    blocks['frames']['samples'] = rng.integers(0, 65536, blocks['frames']['samples'].shape)
+    return blocks.tobytes()
+
+
+def benchDecode(sampleRate=30000, seconds=1, channels=(1, 2, 8), repeats=5):
+    """Blocks decoded per second for `seconds` of data, as readWaveform decodes it.
+    """
+    results = []
+    numBlocks = int(seconds * sampleRate / 128)
+    for numChannels in channels:
+        rawData = randomBlocks(numBlocks, numChannels)
+        times = timeit(lambda: decodeWaveformBlocks(rawData, 1 / sampleRate, 128, None if numChannels == 1 else numChannels,
+                                                    dtype=np.float32), repeats)
+        results.append(result(f"decode.vectorized.{numChannels}ch", numBlocks / np.median(times), 'blocks/s', True))
+
+    # The per-frame loop is single channel only and slow; time a fraction of a second
+    rawData = randomBlocks(max(1, numBlocks // 10))
+    times = timeit(lambda: decodeWaveformBlocksReference(rawData, 1 / sampleRate, 128), max(1, repeats // 2))
+    results.append(result("decode.reference.1ch", max(1, numBlocks // 10) / np.median(times), 'blocks/s', True))
+    return results
+
+
+def benchFeatures(sampleRate=30000, windows=WINDOWS, wavelet='mexh', focusfreq=25, repeats=20, channels=(16, 64)):
+    """Time per decision window of computeCWT (pywt.cwt over every scale, what detectFlexing
+    used to compute), computeFocusPower (the single-scale engine) and the other extractors.
+    The multi-channel CWT is timed on 0.25s windows with a different focusfreq per channel.
+    """
+    results = []
+    engine = FocusScaleCWT(wavelet, SCALES[focusfreq])
+    extractors = {name: makeExtractor(name, sampleRate) for name in FEATURE_EXTRACTORS if name != 'cwt'}
+    rng = np.random.default_rng(0)
+    for window in windows:
+        data = 0.195 * (rng.integers(0, 65536, int(window * sampleRate)) - 32768)
+        results += latencyResults(f"features.computeCWT.{window}s",
+                                  timeit(lambda: pywt.cwt(data, SCALES, wavelet), max(2, repeats // 4)))
+        results += latencyResults(f"features.computeFocusPower.{window}s",
+                                  timeit(lambda: engine.meanPower(data), repeats))
+        for name, extractor in extractors.items():
+            results += latencyResults(f"features.{name}.{window}s", timeit(lambda: extractor.meanPower(data), repeats))
+    for numChannels in channels:
+        data = 0.195 * (rng.integers(0, 65536, (numChannels, int(0.25 * sampleRate))) - 32768)
+        multi = makeExtractor('cwt', sampleRate, wavelet=wavelet, scale=SCALES[rng.integers(5, 31, numChannels)])
+        results += latencyResults(f"features.multichannelCWT.{numChannels}ch",
+                                  timeit(lambda: multi.meanPower(data), max(2, repeats // 4)))
+    return results
+
+
+def connectUncalibrated(simulator, channel=0, flexThresh=0, debug=False):
+    """IntanInterface set up against a simulator without the interactive calibration countdown;
+    flexThresh is fixed instead (the decision itself is not what is being timed).
+    """
+    from intaninterface import IntanInterface
+    interface = IntanInterface(simulator.cmdAddrPort, simulator.waveAddrPort, debug=debug)
+    interface.focusfreq = 25
+    interface.timestep = 1 / simulator.sampleRate
+    interface.buildFeatureEngine()
+    interface.activateChannel()
+    interface.flexThresh = flexThresh
+    return interface
+
+
+def benchDetect(sampleRate=30000, timeframe=0.25, repeats=20, recordRepeats=3):
+    """detectFlexing latency through the whole TCP path against a real-time RHXSimulator.
+    """
+    from rhxsimulator import RHXSimulator
+    results = []
+    with RHXSimulator(sampleRate=sampleRate, cmdPort=0, wavePort=0) as simulator:
+        interface = connectUncalibrated(simulator)
+
+        # Record then read: run mode for `timeframe`, drain the socket, compute
+        results += latencyResults(f"detect.recorded.{timeframe}s",
+                                  timeit(lambda: interface.detectFlexing(timeframe), recordRepeats))
+
+        # Streaming: newest window from the ring buffer
+        interface.startStreaming()
+        interface.latestWindow(timeframe)
+        times = []
+        for _ in range(repeats):
+            times += timeit(lambda: interface.detectFlexing(timeframe), 1)
+            sleep(0.01)
+        results += latencyResults(f"detect.streamed.{timeframe}s", times)
+        interface.stopStreaming()
+
+        # Sliding window: the reader thread already computed the newest power
+        interface.startStreaming(window=timeframe, hop=0.01)
+        interface.latestPower(timeout=timeframe + 1)
+        times = []
+        for _ in range(repeats):
+            times += timeit(lambda: interface.detectFlexing(timeframe), 1)
+            sleep(0.01)
+        results += latencyResults(f"detect.sliding.{timeframe}s", times)
+        interface.stopStreaming()
+    return results
+
+
+def _armWorker(arm, simulator, timeframe, period, results, ready, stop):
+    # controlinterface.arm_worker without the interactive calibration; same decision loop
+    from controlinterface import decisionLoop
+    interface = connectUncalibrated(simulator)
+    interface.startStreaming()
+    interface.latestWindow(timeframe)
+    ready.set()
+    decisionLoop(arm, interface, timeframe, period, results, stop)
+
+
+class _SimulatorAddress:
+    # Picklable stand-in for a simulator for worker processes
+    def __init__(self, simulator):
+        self.cmdAddrPort, self.waveAddrPort = simulator.cmdAddrPort, simulator.waveAddrPort
+        self.sampleRate = simulator.sampleRate
+
+
+def benchArms(sampleRate=30000, timeframe=0.5, periods=(0.05, 0), seconds=5):
+    """Output rate of the two-arm control loop of controlinterface.py: one worker process per
+    arm streaming from its own simulator, decisions paired in the main process and written to
+    the shared-memory control record.
+    """
+    from rhxsimulator import RHXSimulator
+    from controloutput import ControlWriter
+    results = []
+    for period in periods:
+        simulators = {arm: RHXSimulator(sampleRate=sampleRate, cmdPort=0, wavePort=0).start()
+                      for arm in ('left', 'right')}
+        outputs, stop = mp.Queue(maxsize=16), mp.Event()
+        processes = []
+        for arm, simulator in simulators.items():
+            ready = mp.Event()
+            p = mp.Process(target=_armWorker, daemon=True,
+                           args=(arm, _SimulatorAddress(simulator), timeframe, period, outputs, ready, stop))
+            p.start()
+            ready.wait()
+            processes.append(p)
+
+        sink = ControlWriter(('left', 'right'), name=f"intan_control_bench_{os.getpid()}")
+        controls, loopPeriods = {}, []
+        lastOutput = end = monotonic()
+        end += seconds
+        while monotonic() < end:
+            arm, timestamp, flex = outputs.get()
+            controls[arm] = flex
+            if len(controls) < 2:
+                continue
+            sink.write(**controls)
+            controls = {}
+            now = monotonic()
+            loopPeriods.append(now - lastOutput)
+            lastOutput = now
+
+        stop.set()
+        # Keep draining so workers blocked on a full queue can exit
+        while any(p.is_alive() for p in processes):
+            try:
+                outputs.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        sink.close()
+        for simulator in simulators.values():
+            simulator.close()
+
+        name = f"arms.period{period}s"
+        results.append(result(f"{name}.outputs_per_s", len(loopPeriods) / seconds, 'outputs/s', True))
+        results += latencyResults(f"{name}.loop_period", loopPeriods[1:] or [0])
+    return results
+
+
+SUITES = {'decode': benchDecode, 'features': benchFeatures, 'detect': benchDetect, 'arms': benchArms}
+
+
+def run(suites=tuple(SUITES), sampleRate=30000):
+    results = []
+    for suite in suites:
+        print(f"Running {suite}...", file=sys.stderr)
+        results += SUITES[suite](sampleRate=sampleRate)
+    return {
+        'meta': {'time': strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'pywt': pywt.__version__, 'machine': platform.machine(),
+                 'processor': platform.processor(), 'cpus': os.cpu_count(), 'sampleRate': sampleRate},
+        'results': results,
+    }
+
+
+def compare(before, after, threshold=0.1):
+    """Returns rows (name, before, after, unit, change, regressed) for results in both runs.
+    change is relative and signed so that positive = worse.
+    """
+    old = {entry['name']: entry for entry in before['results']}
+    rows = []
+    for entry in after['results']:
+        if entry['name'] not in old or old[entry['name']]['value'] == 0:
+            continue
+        previous = old[entry['name']]['value']
+        change = (entry['value'] - previous) / previous
+        if entry['higherIsBetter']:
+            change = -change
+        rows.append((entry['name'], previous, entry['value'], entry['unit'], change, change > threshold))
+    return rows
+
+
+def printResults(results):
+    for entry in results:
+        print(f"{entry['name']:<48} {entry['value']:>14.4f} {entry['unit']}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='IntanInterface benchmark suite.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    runParser = commands.add_parser('run', help='Run benchmarks and write JSON')
+    runParser.add_argument('--out', help='JSON output file (default: stdout)')
+    runParser.add_argument('--suites', nargs='+', default=list(SUITES), choices=list(SUITES))
+    runParser.add_argument('--samplerate', type=float, default=30000)
+    compareParser = commands.add_parser('compare', help='Flag regressions between two runs')
+    compareParser.add_argument('before')
+    compareParser.add_argument('after')
+    compareParser.add_argument('--threshold', type=float, default=0.1, help='Allowed relative slowdown')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        report = run(args.suites, args.samplerate)
+        if args.out:
+            with open(args.out, 'w') as file:
+                json.dump(report, file, indent=1)
+            printResults(report['results'])
+        else:
+            json.dump(report, sys.stdout, indent=1)
+    else:
+        with open(args.before) as file:
+            before = json.load(file)
+        with open(args.after) as file:
+            after = json.load(file)
+        rows = compare(before, after, args.threshold)
+        for name, previous, value, unit, change, regressed in rows:
+            flag = 'REGRESSION' if regressed else ''
+            print(f"{name:<48} {previous:>12.4f} -> {value:>12.4f} {unit:<10} {change:>+7.1%} worse {flag}")
+        regressions = [row for row in rows if row[-1]]
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%} in {len(rows)} shared results")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,203 @@
+#########################################
+#   RHX Command Client
+#
+#   Request/response handling for the RHX TCP command port. `set`/`execute` commands have no
+#   reply unless they fail, so every batch is sent in one ';'-separated string followed by a
+#   `get runmode`: once its Return arrives, RHX has processed every command before it, and
+#   any replies in between belong to the batch. The closing Return also frames the replies:
+#   they are read until it is complete, however TCP splits them. This replaces fixed sleeps
+#   after each command. CommandClient serves sockets, AsyncCommandClient asyncio streams.
+#
+
+import re
+import socket
+import asyncio
+from time import monotonic
+from interfaceutils import CommandError
+
+REPLY = re.compile(r'(Return:|Error)')
+# Every request ends with this get; RunMode values are whole words, so its Return can be
+# recognized as complete without a terminator
+CLOSING_GET = 'get runmode'
+CLOSING_RETURN = re.compile(r'Return:\s*RunMode\s+(\w+)', re.IGNORECASE)
+RUN_MODES = ('run', 'stop', 'record', 'trigger')
+
+
+def buildRequest(commands):
+    """One ';'-separated send of the commands followed by the closing `get runmode`.
+    """
+    return bytes(";".join(list(commands) + [CLOSING_GET]), 'utf-8')
+
+
+def frameReplies(text, numAnswers):
+    """Finds the replies to one request in the text received so far: first one Return or
+    Error per `get` (numAnswers of them, in order), Error replies of failed set/execute
+    commands, then the closing get's Return. Every reply before the closing Return is complete
+    because another reply follows it; the closing Return is complete once its RunMode value is
+    a whole run mode word.
+
+    Returns (replies, closing run mode, text after the request's replies), or None while the
+    closing Return has not fully arrived.
+    """
+    starts = [match.start() for match in REPLY.finditer(text)]
+    ends = starts[1:] + [len(text)]
+    for i in range(numAnswers, len(starts)):
+        match = CLOSING_RETURN.fullmatch(text[starts[i]:ends[i]].strip())
+        if match is None:
+            continue
+        if match.group(1).lower() not in RUN_MODES:
+            # e.g. 'Return: RunMode Re' of a 'Record' split across segments
+            return None
+        replies = [text[start:end].strip() for start, end in zip(starts[:i], ends[:i])]
+        return replies, match.group(1), text[ends[i]:]
+    return None
+
+
+def parseQuery(names, replies):
+    """{name: value} (lowercase names, string values) from the replies to `get <name>`s.
+    """
+    values = {}
+    for reply in replies:
+        match = re.match(r'Return:\s*(\S+)\s*(.*)', reply)
+        if match:
+            values[match.group(1).lower()] = match.group(2).strip()
+    missing = [name for name in names if name.lower() not in values]
+    if missing:
+        raise CommandError(f"No Return for: {', '.join(missing)} (got {replies})")
+    return values
+
+
+def raiseErrors(replies):
+    errors = [reply for reply in replies if reply.startswith('Error')]
+    if errors:
+        raise CommandError("; ".join(errors))
+
+
+class CommandClient:
+    """Wraps a connected command socket (TCP_NODELAY is turned on).
+
+    timeout: default seconds to wait for the replies of one call.
+    """
+    def __init__(self, sock, timeout=1, bufferSize=4096):
+        self.sock = sock
+        self.timeout = timeout
+        self.bufferSize = bufferSize
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__pending = ''
+
+    def query(self, *names, timeout=None):
+        """Sends `get <name>` for every name in one batch. Returns {name: value} (lowercase
+        names, string values).
+        """
+        replies, mode = self.__request([f"get {name}" for name in names], len(names), timeout)
+        return parseQuery(names, replies)
+
+    def get(self, name, timeout=None):
+        return self.query(name, timeout=timeout)[name.lower()]
+
+    def execute(self, *commands, timeout=None):
+        """Sends the `set`/`execute` commands in one batch and waits until RHX has processed
+        them. Raises CommandError with every Error reply. Returns the run mode afterwards.
+        """
+        # Only failing commands are answered; the closing get's Return confirms the rest
+        replies, mode = self.__request(commands, 0, timeout)
+        raiseErrors(replies)
+        return mode
+
+    def setRunMode(self, mode, timeout=None):
+        """set runmode run|stop, returning once RHX reports the new mode.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        current = self.execute(f"set runmode {mode}", timeout=timeout)
+        # RHX may report the old mode while it is still starting/stopping the controller
+        while current.lower() != mode.lower():
+            if monotonic() > deadline:
+                raise TimeoutError(f"RHX run mode is {current}, not {mode}, after {timeout}s.")
+            current = self.execute(timeout=max(0, deadline - monotonic()))
+        return current
+
+    def __request(self, commands, numAnswers, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        request = buildRequest(commands)
+        self.sock.sendall(request)
+
+        text, self.__pending = self.__pending, ''
+        originalTimeout = self.sock.gettimeout()
+        try:
+            # Read until the closing Return is complete, however the replies are segmented
+            while (framed := frameReplies(text, numAnswers)) is None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No complete reply to '{str(request, 'utf-8')}' within {timeout}s.")
+                self.sock.settimeout(remaining)
+                try:
+                    data = self.sock.recv(self.bufferSize)
+                except socket.timeout:
+                    raise TimeoutError(f"No complete reply to '{str(request, 'utf-8')}' within {timeout}s.")
+                if not data:
+                    raise ConnectionError('Command socket was closed by the server.')
+                text += str(data, 'utf-8')
+        finally:
+            self.sock.settimeout(originalTimeout)
+        replies, mode, self.__pending = framed
+        return replies, mode
+
+
+class AsyncCommandClient:
+    """CommandClient for asyncio streams (same framing, batching and confirmation).
+    """
+    def __init__(self, reader, writer, timeout=1, bufferSize=4096):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.bufferSize = bufferSize
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__pending = ''
+
+    async def query(self, *names, timeout=None):
+        replies, mode = await self.__request([f"get {name}" for name in names], len(names), timeout)
+        return parseQuery(names, replies)
+
+    async def get(self, name, timeout=None):
+        return (await self.query(name, timeout=timeout))[name.lower()]
+
+    async def execute(self, *commands, timeout=None):
+        replies, mode = await self.__request(commands, 0, timeout)
+        raiseErrors(replies)
+        return mode
+
+    async def setRunMode(self, mode, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        current = await self.execute(f"set runmode {mode}", timeout=timeout)
+        while current.lower() != mode.lower():
+            if monotonic() > deadline:
+                raise TimeoutError(f"RHX run mode is {current}, not {mode}, after {timeout}s.")
+            current = await self.execute(timeout=max(0, deadline - monotonic()))
+        return current
+
+    async def __request(self, commands, numAnswers, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        request = buildRequest(commands)
+        self.writer.write(request)
+        await self.writer.drain()
+
+        text, self.__pending = self.__pending, ''
+        while (framed := frameReplies(text, numAnswers)) is None:
+            remaining = deadline - monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                data = await asyncio.wait_for(self.reader.read(self.bufferSize), remaining)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"No complete reply to '{str(request, 'utf-8')}' within {timeout}s.")
+            if not data:
+                raise ConnectionError('Command socket was closed by the server.')
+            text += str(data, 'utf-8')
+        replies, mode, self.__pending = framed
+        return replies, mode
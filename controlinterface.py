@@ -1,74 +1,179 @@
 from intaninterface import IntanInterface
+from controloutput import ControlWriter, CSVControlSink
 import multiprocessing as mp
-from time import time
-import os
+from time import time, monotonic, sleep, strftime
+from collections import deque
+import queue
+import signal
 
-def multiprocess_arm(interface, timeframe, arm, q):
-    measure = interface.detectFlexing(timeframe=timeframe)
-    
-    q.put((arm, measure))
+def arm_worker(arm, cmdAddrPort, waveAddrPort, channel, recordtime, timeframe, period, results, ready, stop, debug,
+               instrument=False, capture=False):
+    """Long-lived worker for one arm. Owns its own IntanInterface (connection + calibration)
+    and pushes (arm, timestamp, flex) for every decision into the bounded `results` queue.
+    Decisions are made on the newest `timeframe` seconds of the stream every `period` seconds.
+
+    instrument: record per-stage latencies; printed and written to latency-<arm>.json on stop,
+        with the stream statistics (printed anyway if samples were dropped).
+    capture: keep the raw stream and decisions in captures/ for replay (see streamcapture.py).
+    """
+    # Ctrl-C reaches the whole process group; the main process ends the loop with `stop` instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    interface = IntanInterface(cmdAddrPort, waveAddrPort, debug=debug)
+    if instrument:
+        interface.enableTimings(arm)
+    interface.setup(recordtime=recordtime, channel=channel, profile=arm)
+    if capture:
+        interface.startCapture(f"{interface.captureDir}/{arm}-{strftime('%Y%m%d-%H%M%S')}.rhxcap")
+    interface.startStreaming()
+    ready.set()
+    decisionLoop(arm, interface, timeframe, period, results, stop, instrument)
+
+def decisionLoop(arm, interface, timeframe, period, results, stop, instrument=False):
+    """A worker's loop on a streaming interface until `stop` is set: one decision every `period`
+    seconds, then the stream is stopped and reported (see arm_worker).
+    """
+    try:
+        nextDecision = monotonic()
+        while not stop.is_set():
+            nextDecision += period
+            sleep(max(0, nextDecision - monotonic()))
+            measure = interface.detectFlexing(timeframe=timeframe)
+            try:
+                results.put((arm, monotonic(), measure), timeout=1)
+            except queue.Full:
+                # Main loop stopped consuming; drop this decision rather than block forever
+                continue
+    finally:
+        # Also when a decision failed, e.g. RHX closed the connection
+        try:
+            interface.stopStreaming()
+            interface.stopCapture()
+        finally:
+            # Reported even if stopping RHX failed, e.g. on a closed command socket
+            report(arm, interface, instrument)
+
+def report(arm, interface, instrument):
+    """Prints the stream statistics and, with instrument, the latency percentiles and writes
+    them to latency-<arm>.json.
+    """
+    if instrument:
+        print(interface.timings.format())
+        interface.timings.export(f"latency-{arm}.json")
+        print(f"Latency percentiles ({arm}) written to latency-{arm}.json")
+    stats = interface.streamStats()
+    if instrument or stats['gaps']:
+        print(f"Stream ({arm}): {stats['gaps']} gaps, {stats['lostSamples']} samples lost, "
+              f"max backlog {stats['maxBacklog']} of {stats['rcvbuf']} byte receive buffer")
+
+def deadWorkers(processes):
+    """Arms whose worker process has exited, e.g. after a failed connect or setup.
+    """
+    return [arm for arm, p in processes.items() if not p.is_alive()]
+
+def stopWorkers(processes, stop, timeout):
+    stop.set()
+    for p in processes.values():
+        p.join(timeout=timeout)
 
 if __name__ == "__main__":
     debug=False
+    instrument=False  # Per-stage latency percentiles per arm, see IntanInterface.enableTimings
+    capture=False  # Keep each arm's raw stream for replay, see IntanInterface.startCapture
+    legacyCSV=True  # Also write control.csv for games that still poll it
     arms = {}
-    
+
     # Intro
     print("##########################################")
     print("# Welcome to Intan Control Interface.")
     print("# ECE202 W24 Group 7")
     print()
     print("This interface requires two electrodes/channels for EMG recording, one for each arm")
-    
+
     # Connect Right Arm
     print("\033[91mPlease turn on RIGHT Arm's Intan TCP Control with \033[93m\033[1mCommands to 127.0.0.1:5000\033[91m and \033[93m\033[1mOutput to 127.0.0.1:5001\033[0m")
     input("Press ENTER when ready to connect.")
-    arms['right'] = IntanInterface(('127.0.0.1', 5000), ('127.0.0.1', 5001), debug=debug)
-    
+    arms['right'] = {'cmd': ('127.0.0.1', 5000), 'wave': ('127.0.0.1', 5001), 'recordtime': 5}
+
     # Connect Left Arm
     print("\033[91mPlease turn on LEFT Arm's Intan TCP Control with \033[93m\033[1mCommands to 127.0.0.1:5002\033[91m and \033[93m\033[1mOutput to 127.0.0.1:5003\033[0m")
     input("Press ENTER when ready to connect.")
-    arms['left'] = IntanInterface(('127.0.0.1', 5002), ('127.0.0.1', 5003), debug=debug)
+    arms['left'] = {'cmd': ('127.0.0.1', 5002), 'wave': ('127.0.0.1', 5003), 'recordtime': 3}
     print()
-    
+
     # Get Channel Numbers
-    rightchannel = int(input("Please input left arm's channel number (e.g. 23): "))
-    leftchannel = int(input("Please input right arm's channel number (e.g. 23): "))
-    
-    # Setup and Calibration
-    input("Electrodes must be calibrated. When ready press ENTER to begin calibration of both arms")
-    print("\033[96mCalibrating RIGHT arm...\033[0m")
-    arms['right'].setup(recordtime=5, channel=rightchannel)
-    print("\033[96mCalibrating LEFT arm...\033[0m")
-    arms['left'].setup(recordtime=3, channel=leftchannel)
+    arms['right']['channel'] = int(input("Please input right arm's channel number (e.g. 23): "))
+    arms['left']['channel'] = int(input("Please input left arm's channel number (e.g. 23): "))
 
-    processes = []
+    # Setup and Calibration: one persistent worker per arm, calibrated one after the other
+    input("Electrodes must be calibrated. When ready press ENTER to begin calibration of both arms")
     timeframe=0.5
+    period=0.05
+    outputs = mp.Queue(maxsize=16)
+    stop = mp.Event()
+    processes = {}
+    for arm in ['right', 'left']:
+        print(f"\033[96mCalibrating {arm.upper()} arm...\033[0m")
+        ready = mp.Event()
+        config = arms[arm]
+        p = mp.Process(target=arm_worker, daemon=True,
+                       args=(arm, config['cmd'], config['wave'], config['channel'], config['recordtime'],
+                             timeframe, period, outputs, ready, stop, debug, instrument, capture))
+        processes[arm] = p
+        p.start()
+        # A worker that fails to connect or calibrate never signals ready
+        while not ready.wait(timeout=1):
+            if not p.is_alive() and not ready.is_set():
+                print(f"\033[91m{arm.upper()} arm worker exited (code {p.exitcode}) before it was ready.\033[0m")
+                stopWorkers(processes, stop, timeframe + 2)
+                exit(1)
+
+    # Decisions go to shared memory (see controloutput.ControlReader for the game side)
+    sinks = [ControlWriter(('left', 'right'))]
+    if legacyCSV:
+        sinks.append(CSVControlSink(('left', 'right'), onlyIfMissing=True))
+
     # Repeat until quit
     start = time()
-    controlqueue = []
-    while True:
-        outputs = mp.Queue()
-        
-        # Start thread of both arms
-        for arm , interface in arms.items():
-            p = mp.Process(target=multiprocess_arm, args=(interface, timeframe, arm, outputs))
-            processes.append(p)
-            p.start()
-
-        # Rejoin thread
-        for p in processes:
-            p.join()
-            
-        controls = {}
-        # Check thread output (if arm was flexed or not)
-        for _ in range(0, 2):
-            arm, flex = outputs.get(False)
+    controls = {}
+    periods = deque(maxlen=100)
+    periodSum, periodCount = 0, 0
+    lastOutput = monotonic()
+    try:
+        while True:
+            # Collect the next decision of either arm (no process spawned per decision)
+            try:
+                arm, timestamp, flex = outputs.get(timeout=1)
+            except queue.Empty:
+                arm = None
+            dead = deadWorkers(processes)
+            if dead:
+                # Without that arm's decisions no control record would be written again
+                print(f"\033[91m{', '.join(dead).upper()} arm worker exited, stopping.\033[0m")
+                break
+            if arm is None:
+                continue
             controls[arm] = flex
-            
-        controlqueue.append(f"{controls['left']}, {controls['right']}")
-        
-        if not os.path.exists('control.csv'):
-            with open('control.csv', 'w') as file:
-                file.write(controlqueue.pop(0))
-        
-    print("Elapsed:", time() - start)
\ No newline at end of file
+            if len(controls) < 2:
+                continue
+
+            for sink in sinks:
+                sink.write(**controls)
+            controls = {}
+
+            now = monotonic()
+            periods.append(now - lastOutput)
+            periodSum, periodCount = periodSum + now - lastOutput, periodCount + 1
+            lastOutput = now
+            if debug and periodCount % 100 == 0:
+                print(f"[DEBUG] Mean loop period over last 100: {sum(periods) / len(periods) * 1000:.1f}ms")
+
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopWorkers(processes, stop, timeframe + 2)
+        for sink in sinks:
+            sink.close()
+
+    print("Elapsed:", time() - start)
+    if periodCount:
+        print(f"Mean loop period: {periodSum / periodCount * 1000:.1f}ms over {periodCount} iterations")
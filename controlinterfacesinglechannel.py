@@ -1,9 +1,10 @@
 from intaninterface import IntanInterface
+from controloutput import ControlWriter, CSVControlSink
 from time import time, sleep
-import os
 
 if __name__ == "__main__":
     debug=False
+    legacyCSV=True  # Also write control.csv for games that still poll it
     arms = {}
     
     # Intro
@@ -24,7 +25,13 @@ if __name__ == "__main__":
     # Setup and Calibration
     input("Electrodes must be calibrated. When ready press ENTER to begin calibration.")
     print("\033[96mCalibrating arm...\033[0m")
-    interface.setup(recordtime=3, channel=rightchannel)
+    interface.setup(recordtime=3, channel=rightchannel, profile=True)
+    interface.startStreaming()
+
+    # Decisions go to shared memory (see controloutput.ControlReader for the game side)
+    sinks = [ControlWriter(('flex',))]
+    if legacyCSV:
+        sinks.append(CSVControlSink(('flex',)))
 
     processes = []
     timeframe=0.2
@@ -34,8 +41,8 @@ if __name__ == "__main__":
         measure = interface.detectFlexing(timeframe=timeframe)
         print(measure)    
         
-        with open('control.csv', 'w') as file:
-            file.write(str(measure))
+        for sink in sinks:
+            sink.write(flex=measure)
         sleep(0.2)
         
     print("Elapsed:", time() - start)
\ No newline at end of file
@@ -0,0 +1,131 @@
+#########################################
+#   Control Output
+#
+#   Publishes the latest flex decisions to the game through a small shared-memory record
+#   instead of rewriting control.csv. The record is guarded by a sequence counter (odd while
+#   being written), so readers never see a half-written update and can tell new updates apart.
+#
+#   Layout: uint64 sequence | float64 monotonic timestamp | uint32 field count | uint8 per field
+#
+
+import os
+import struct
+from time import monotonic, sleep
+from multiprocessing import shared_memory, resource_tracker
+
+CONTROL_NAME = 'intan_control'
+HEADER = struct.Struct('<QdI')
+
+
+def recordSize(numFields):
+    return HEADER.size + numFields
+
+
+class ControlWriter:
+    """Owns the shared-memory record. write() publishes one decision per field, e.g.
+    ControlWriter(('left', 'right')).write(left=True, right=False).
+    """
+    def __init__(self, fields=('left', 'right'), name=CONTROL_NAME):
+        self.fields = tuple(fields)
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=recordSize(len(self.fields)))
+        except FileExistsError:
+            # Left over from a previous session that did not unlink it
+            self.shm = shared_memory.SharedMemory(name=name)
+            if self.shm.size < recordSize(len(self.fields)):
+                size = self.shm.size
+                self.shm.close()
+                raise ValueError(f"Shared memory '{name}' holds {size} bytes but {len(self.fields)} fields need "
+                                 f"{recordSize(len(self.fields))}; unlink it or use another name.")
+        self.seq = 0
+        HEADER.pack_into(self.shm.buf, 0, self.seq, monotonic(), len(self.fields))
+        self.shm.buf[HEADER.size:recordSize(len(self.fields))] = bytes(len(self.fields))
+
+    def write(self, **states):
+        values = bytes(bool(states[field]) for field in self.fields)
+        buf = self.shm.buf
+
+        # Odd sequence = write in progress
+        struct.pack_into('<Q', buf, 0, self.seq + 1)
+        struct.pack_into('<d', buf, 8, monotonic())
+        buf[HEADER.size:HEADER.size + len(values)] = values
+        self.seq += 2
+        struct.pack_into('<Q', buf, 0, self.seq)
+
+    def close(self, unlink=True):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class ControlReader:
+    """Reader API for the game: attach by name, then read() or waitForUpdate().
+    """
+    def __init__(self, name=CONTROL_NAME):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13: stop the resource tracker from unlinking the writer's record
+            # when this reader exits. POSIX only: Windows has no tracker for shared memory and
+            # frees the record with its last handle. The tracker keys segments by '/' + name.
+            self.shm = shared_memory.SharedMemory(name=name)
+            if os.name == 'posix':
+                resource_tracker.unregister('/' + self.shm.name, 'shared_memory')
+
+    def read(self):
+        """Returns (sequence, monotonic timestamp, tuple of bools) of the latest update.
+        A sequence of 0 means nothing has been written yet.
+        """
+        buf = self.shm.buf
+        while True:
+            seq, timestamp, numFields = HEADER.unpack_from(buf, 0)
+            values = tuple(bool(value) for value in buf[HEADER.size:HEADER.size + numFields])
+            # Retry if the writer was mid-update
+            if seq % 2 == 0 and struct.unpack_from('<Q', buf, 0)[0] == seq:
+                return seq, timestamp, values
+
+    def waitForUpdate(self, lastSeq, timeout=None, poll=0.0001):
+        """Spins until the sequence moves past lastSeq. Returns the new read() or None on timeout.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            update = self.read()
+            if update[0] != lastSeq:
+                return update
+            if deadline is not None and monotonic() > deadline:
+                return None
+            sleep(poll)
+
+    def close(self):
+        self.shm.close()
+
+
+class CSVControlSink:
+    """Legacy control.csv output with the same write() interface as ControlWriter.
+
+    onlyIfMissing: only write when the game has consumed (deleted) the previous file, as the
+    two-arm controller always did.
+    """
+    def __init__(self, fields=('left', 'right'), path='control.csv', onlyIfMissing=False):
+        self.fields = tuple(fields)
+        self.path = path
+        self.onlyIfMissing = onlyIfMissing
+
+    def write(self, **states):
+        if self.onlyIfMissing and os.path.exists(self.path):
+            return
+        with open(self.path, 'w') as file:
+            file.write(", ".join(str(states[field]) for field in self.fields))
+
+    def close(self, unlink=True):
+        pass
+
+
+if __name__ == "__main__":
+    # Print every update of a running controller
+    reader = ControlReader()
+    seq = 0
+    while True:
+        seq, timestamp, values = reader.waitForUpdate(seq)
+        print(f"#{seq // 2} {monotonic() - timestamp:.6f}s ago: {values}")
@@ -1,31 +1,67 @@
+import os
+import queue
 import socket
+import threading
+from collections import deque
 from interfaceutils import *
-from time import sleep
+from featureengine import SlidingPower, Decimator
+from interfacebase import IntanInterfaceBase
+from commandclient import CommandClient
+from liveviewer import LiveViewer
+from streamcapture import CaptureWriter
+from contextlib import nullcontext
+from time import sleep, monotonic, perf_counter, strftime
 import numpy as np
 import pywt
 import matplotlib.pyplot as plt
 
 HOST = '127.0.0.1'
 PORT = 5001
+NO_TIMING = nullcontext()
+STREAM_POLL = 0.05  # Seconds the stream reader waits for data before checking for stopStreaming
 
-class IntanInterface:
-    def __init__(self, cmdAddrPort, waveAddrPort, timeout=5, debug=False):
-        # Init immutable constants.
-        self.__debug = debug
-        self.__setup_lock = False
-        
-        # Init any mutable constant vars NOTE: Change here to reflect to all objects, or change externally for single object
-        self.buffersize = 200000
-        self.frames_per_block = 128
-        self.wavelet = 'mexh'
-        self.threshRatio = 0.75
+class IntanInterface(IntanInterfaceBase):
+    def __init__(self, cmdAddrPort=None, waveAddrPort=None, timeout=5, debug=False, source=None, rcvbuf=None):
+        """source: optional offline waveform source (e.g. rhdreader.RecordingSource). With a
+        source no RHX connection is made, and setup/calibrate/detectFlexing read from it instead.
+        rcvbuf: receive buffer (SO_RCVBUF) of the waveform socket in bytes, None = OS default.
+        It bounds how much RHX can send while the reader is not reading (e.g. during record());
+        see streamStats for the size granted and how full it gets.
+        """
+        super().__init__(debug)
+        self.__streaming = False
+        self.__streamThread = None
+        self.__blockReader = None
+        self.__powerCond = threading.Condition()
+        self.__streamStart = None       # RHX time of the first streamed sample
+        self.__recalibrations = None    # Queue of labeled segments for __recalibrator
+        self.__recalibrator = None
+        self.__onlinePowers = {}
+        self.__streamDecimator = None   # Stateful decimation in front of slidingPower
+        self.ring = None
+        self.__buffers = BufferPool()   # Reused decision windows (caller's thread)
+        self.__streamBuffers = BufferPool()     # Stream scaling scratch (stream reader thread)
+        self.slidingPower = None
+        self.powers = deque(maxlen=1024)
+        self.timings = None         # LatencyRecorder, see enableTimings
+        self.viewer = None          # LiveViewer, see startViewer
+        self.capture = None         # CaptureWriter, see startCapture
+        self.rcvbuf = None          # SO_RCVBUF granted for the waveform socket
+        self.__runStart = None      # monotonic() when run mode was last entered
+        self.__clockOffset = None   # monotonic() - RHX frame time of the current run
+        self.captureDir = 'captures'
+
+        # Offline: everything is read from the source, nothing to connect to
+        self.source = source
+        if source is not None:
+            return
 
         # Connect to TCP command server - default home IP address at port 5000.
         print('Connecting to TCP command server...')
         try: 
             self.cmd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.cmd.settimeout(timeout)  # Set connection timeout
-            self.__debugOut(f"Attempting to connect to {cmdAddrPort}. Timeout = 5s")
+            self._debugOut(f"Attempting to connect to {cmdAddrPort}. Timeout = 5s")
             self.cmd.connect(cmdAddrPort)
         except socket.timeout:
             print("Connection timeout. Please make sure TCP command port is connected on Intan")
@@ -34,13 +70,17 @@ class IntanInterface:
             print(f"Some error occured: {e}.\nPlease check your TCP waveform port on Intan.")
             exit(1)
         print(f"Connected to {cmdAddrPort[0]}:{cmdAddrPort[1]}")
+        self.commands = CommandClient(self.cmd, timeout)
 
         # Connect to TCP waveform server - default home IP address at port 5001.
         print('Connecting to TCP waveform server...')
         try:
             self.wave = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.wave.settimeout(timeout)  # Set connection timeout
-            self.__debugOut(f"Attempting to connect to {waveAddrPort}. Timeout = 5s")
+            # Before connect, so the TCP window can be scaled to the buffer
+            self.rcvbuf = setReceiveBuffer(self.wave, rcvbuf)
+            self._debugOut(f"Waveform receive buffer: {self.rcvbuf} bytes (requested {rcvbuf})")
+            self._debugOut(f"Attempting to connect to {waveAddrPort}. Timeout = 5s")
             self.wave.connect(waveAddrPort)
         except socket.timeout:
             print("Connection timeout. Please make sure TCP waveform port is connected on Intan.")
@@ -53,74 +93,102 @@ class IntanInterface:
     def setup(self, **kwargs):
         """
         Opt Inputs:
-            channel: channel number
+            channel: channel number, or a list of channel numbers to read all of them from this
+                     one RHX instance (data is then (channels, samples) in ascending channel order)
             recordtime: recording time; this will be used for calibration
+            focusfreq: index into scales, or a list with one per channel (in the order of `channel`);
+                     all channels still run in one batched CWT, see featureengine.MultiChannelCWT
+            feature: feature extractor, 'cwt' (default), 'rms', 'bandpower' or 'teager'; the
+                     O(n) ones cost a fraction of the CWT per decision. featureoptions: its options
+            decimation: decimate by this factor before the feature ('auto' picks the largest
+                     factor that keeps the cwt focus scale >= 8 samples wide, or the bandpower
+                     band in the decimated passband; rms and teager need a factor)
+            profile: True (or a name, e.g. the arm, prefixed to the channel key) to reuse a saved
+                     calibration profile instead of calibrating. A full calibration runs (and is saved)
+                     when there is no profile younger than `maxage` seconds (default 1 day) made with
+                     this setup's feature settings, or the `validatetime`-second resting check
+                     (default 0.5) does not match it.
         """
-        override = False if 'override' not in kwargs else kwargs['override']
-        if self.__setup_lock and not override:
-            self.__debugOut("Re-setup blocked by __setup_lock. To re-setup, use override=True.")
-            raise SetupReplaceReject(
-                'Reject action to re-setup/calibrate an IntanInterface object.'
-            )
+        setupStart = perf_counter()
+        recordtime, channel = self.applySetup(kwargs)
         
-        recordtime = 1 if 'recordtime' not in kwargs else kwargs['recordtime']
-        self.__channel = 0 if 'channel' not in kwargs else kwargs['channel']
-        self.focusfreq = 25 if 'focusfreq' not in kwargs else kwargs['focusfreq']
-        self.__debugOut(f"Setup: recordtime={recordtime}, channel={self.__channel}, focusfreq={self.focusfreq}")
+        # Offline source: same channel selection, calibration straight from the recording
+        if self.source is not None:
+            self.timestep = self.source.timestep
+            self.buildFeatureEngine()
+            self.source.select(channel)
+            self.calibrate(**{key: value for key, value in kwargs.items() if key != 'override'})
+            self._setupLock = True
+            self.__observe('setup', setupStart)
+            return
         
         ## Setup Intan Software
-        # Query runmode from RHX software.
-        self.cmd.sendall(b'get runmode')
-        commandReturn = str(self.cmd.recv(self.buffersize), "utf-8")
-        
-        # If controller is running, stop it.
-        if commandReturn != "Return: RunMode Stop":
-            self.__debugOut("Stopping controller...")
-            self.cmd.sendall(b'set runmode stop')
-            # Allow time for RHX software to accept this command before the next.
-            sleep(0.1)
-
-        # Query sample rate from RHX software.
-        self.cmd.sendall(b'get sampleratehertz')
-        commandReturn = str(self.cmd.recv(self.buffersize), "utf-8")
-        expectedReturnString = "Return: SampleRateHertz "
-        # Look for "Return: SampleRateHertz N" where N is the sample rate.
-        if commandReturn.find(expectedReturnString) == -1:
+        commandsStart = perf_counter()
+        # Query runmode and sample rate from RHX software in one round trip.
+        try:
+            replies = self.commands.query('runmode', 'sampleratehertz')
+            sampleRate = float(replies['sampleratehertz'])
+        except (CommandError, ValueError):
             raise GetSampleRateFailure(
                 'Unable to get sample rate from server.'
             )
         
-        self.timestep = 1 / float(commandReturn[len(expectedReturnString):])
+        # If controller is running, stop it (returns once RHX reports Stop).
+        if replies['runmode'] != "Stop":
+            self._debugOut("Stopping controller...")
+            self.commands.setRunMode('stop')
+        
+        self.timestep = 1 / sampleRate
+        
+        # Build the feature extractor (e.g. the focus-scale wavelet kernel) once
+        self.buildFeatureEngine()
         
         # Activate Channel
         self.activateChannel()
+        self.__observe('setup.commands', commandsStart)
         
-        # Calibrate electrode 
-        self.calibrate(recordtime=recordtime)
+        # Calibrate electrode, unless a saved profile still matches a short resting window
+        profile = kwargs.get('profile')
+        name = None if profile is True else profile
+        saved = self.loadProfile(name, kwargs.get('maxage', 24 * 3600)) if profile else None
+        if saved is not None and self.validateProfile(saved, kwargs.get('validatetime', 0.5)):
+            self.applyProfile(saved)
+            print("Using saved calibration. Threshold for Flexing classification: ", self.flexThresh)
+        else:
+            self.calibrate(recordtime=recordtime)
+            if profile:
+                self.saveProfile(name)
         
-        self.__setup_lock = True
+        self._setupLock = True
+        self.__observe('setup', setupStart)
 
     def calibrate(self, **kwargs):
         """Time for calibration **per** action, i.e. if recordtime=5, it is 5 seconds for resting and 5 seconds for flexing
         
         recordtime: Time for calibration per action; thus, total calibration recordtime is recordtime * 2 (+ 16 seconds buffer/prep)
+        restingstart, flexingstart: offline source only; where (in seconds) each segment starts in the
+            recording. Without them, segments are read back to back from the source's position.
         
         Returns: 
         """
-        override = False if 'override' not in kwargs else kwargs['override']
-        if self.__setup_lock and not override:
-            self.__debugOut("Re-calibration blocked by __setup_lock. To re-calibrate, use override=True.")
-            raise ChannelChangeReject(
-                'Reject action to change channel.'
-            )
-            
-        recordtime = 1 if 'recordtime' not in kwargs else kwargs['recordtime']
-        self.__debugOut(f"Calibration: recordtime={recordtime}, threshRatio={self.threshRatio}")
+        calibrateStart = perf_counter()
+        recordtime = self.applyCalibrate(kwargs)
         
         calibrations = {}
         modes = ["Resting", "Flexing"]
         # Run controller for 10 seconds for calibration
         for mode in modes:
+            if self.source is not None:
+                # Offline: no countdown, take the segment straight from the recording
+                start = kwargs.get(f'{mode.lower()}start')
+                if start is not None:
+                    self.source.seek(start)
+                self._debugOut(f"{mode} calibration from {self.source.tell():.2f}s")
+                timestamps, data = self.source.read(recordtime)
+                calibrations[mode] = self.computeFocusPower(data)
+                self._debugOut(f"Mean {mode} Power: ", calibrations[mode])
+                continue
+
             print(f"Running {mode} calibration for {recordtime} seconds. Please begin {mode}.")
             print("Beginning in 5 seconds...")
             sleep(1)
@@ -129,107 +197,415 @@ class IntanInterface:
                 sleep(1)
             print("Calibrating...")
             
-            # run for `recordtime` amount of seconds
-            self.record(recordtime)
+            # run for `recordtime` amount of seconds and read the waveform
+            lost = self.continuity.lostSamples
+            timestamps, data = self.recordRead(recordtime)
+            self.warnLost(self.continuity.lostSamples - lost, mode)
             print("Finished.")
             sleep(2)
             
-            # Read waveform
-            timestamps, data = self.readWaveform(recordtime)
-            
-            # Comptue CWT
-            coef, freq = self.computeCWT(data)
-
-            # Comput mean at object's freq
-            mean = np.mean(np.abs(coef[self.focusfreq]))
-            self.__debugOut(f"Mean {mode} Power: ", mean)
+            # Comput mean power at object's freq
+            mean = self.computeFocusPower(data)
+            self._debugOut(f"Mean {mode} Power: ", mean)
             calibrations[mode] = mean
             
-            # Debug view CWT Spectrogram
-            if self.__debug:
-                self.viewCWT(coef)
+            # Debug view CWT Spectrogram, drawn by the viewer process without blocking
+            if self._debug:
+                if self.viewer is None:
+                    self.startViewer()
+                self.__publishView(timestamps, data)
+
+        self.setThreshold(calibrations)
+        self.__observe('calibrate', calibrateStart)
 
-        threshDiff = (calibrations['Flexing'] - calibrations['Resting']) * self.threshRatio
-        self.flexThresh = calibrations['Resting'] + threshDiff
-        print("Threshold for Flexing classification: ", self.flexThresh)
+    def validateProfile(self, profile, recordtime=0.5, tolerance=0.5):
+        """Records `recordtime` seconds at rest and checks its power against the resting mean of
+        `profile` (see loadProfile): it must lie within `tolerance` of the resting-to-threshold gap.
+        Nothing is applied; see applyProfile.
+        """
+        print(f"Checking saved calibration: please stay resting for {recordtime} seconds...")
+        timestamps, data = self.recordRead(recordtime)
+        return self.matchesProfile(self.computeFocusPower(data), profile, tolerance)
 
     def detectFlexing(self, timeframe=1):
-        timestamps, data = self.recordRead(timeframe)
+        detectStart = perf_counter()
+        # With a sliding window the stream reader already computed the newest power
+        if self.__streaming and self.slidingPower is not None:
+            with self.__stage('detectFlexing.window'):
+                timestamp, mean = self.latestPower()
+            self._debugOut(f"Sliding Mean Power: {mean}")
+        else:
+            # In streaming mode the newest window is already buffered, otherwise record one now
+            with self.__stage('detectFlexing.window'):
+                if self.__streaming:
+                    # Same window size every call: copy into reused arrays
+                    n = round(timeframe / self.timestep)
+                    shape = (n,) if self._numChannels is None else (self._numChannels, n)
+                    out = (self.__buffers.get('timestamps', n), self.__buffers.get('window', shape, self.featureDtype))
+                    timestamps, data = self.latestWindow(timeframe, out=out)
+                else:
+                    timestamps, data = self.recordRead(timeframe)
+            timestamp = timestamps[-1]
+
+            # Comput mean power at object's freq
+            mean = self.computeFocusPower(data)
+            self._debugOut(f"Sample Mean Power: {mean}")
+
+        with self.__stage('detectFlexing.compare'):
+            flex = mean > self.flexThresh
+        if self.timings is not None:
+            self.timings.observe('detectFlexing', perf_counter() - detectStart)
+            if self.__clockOffset is not None and self.source is None:
+                # How old the newest sample the decision is based on is (since it was sampled)
+                self.timings.observe('sampleAge', monotonic() - (self.__clockOffset + timestamp))
+        if self.capture is not None:
+            self.capture.writeDecision(timestamp, mean, flex)
+        if self.viewer is not None:
+            self.viewer.writeTrace(timestamp, mean, self.flexThresh, flex)
+            if not (self.__streaming and self.slidingPower is not None):
+                self.__publishView(timestamps, data)
+        return flex
+
+    def enableTimings(self, name=None, capacity=1024):
+        """Starts recording per-stage latencies (setup, calibrate, detectFlexing, record,
+        readWaveform, computeCWT, computeFocusPower, stream reader) and the sample age at
+        decision time into self.timings, a LatencyRecorder. Set self.timings = None to stop.
+        """
+        self.timings = LatencyRecorder(name, capacity)
+        return self.timings
+
+    def startCapture(self, path=None):
+        """Appends every waveform block received from now on (streamed or recorded) and every
+        detectFlexing decision to a capture directory (default captures/<date>-<time>.rhxcap)
+        for replay with streamcapture.CaptureReader. Returns the path.
+        """
+        if self.source is not None:
+            raise StreamNotRunning('Capture needs an RHX connection; offline sources are already on disk.')
+        self.stopCapture()
+        path = os.path.join(self.captureDir, strftime('%Y%m%d-%H%M%S') + '.rhxcap') if path is None else path
+        self.capture = CaptureWriter(path, 1 / self.timestep, self.frames_per_block, self._channels)
+        self._debugOut(f"Capturing to {path}")
+        return path
+
+    def stopCapture(self):
+        if self.capture is not None:
+            self.capture.close()
+            if self.capture.dropped:
+                print(f"Warning: capture {self.capture.path} dropped {self.capture.dropped} writes (disk too slow).")
+            self.capture = None
+
+    def startViewer(self, seconds=10, columnRate=100, fps=10, outdir=None):
+        """Starts the live viewer process (see liveviewer.py): the |CWT| of the first channel
+        over the last `seconds` at `columnRate` columns/s, plus the feature, threshold and
+        decision of every detectFlexing call, redrawn at `fps`. Headless sessions (or outdir)
+        render to outdir/spectrogram.png (default viewer/). The viewer process computes the CWT;
+        a decision only copies its new samples and trace point into shared memory.
+        """
+        if self.viewer is None:
+            self.viewer = LiveViewer(self.scales, 1 / self.timestep, len(self._channels), seconds, columnRate,
+                                     fps, outdir, self.wavelet)
+        return self.viewer
+
+    def stopViewer(self):
+        if self.viewer is not None:
+            self.viewer.close()
+            self.viewer = None
+
+    def __publishView(self, timestamps, data):
+        # Raw samples of the first channel only; the viewer process computes their CWT
+        self.viewer.publish(timestamps, np.atleast_2d(data)[0])
+
+    def startStreaming(self, buffertime=10, window=None, hop=None):
+        """Puts the controller in run mode and keeps it there. A background thread drains the
+        waveform socket into a ring buffer of the last `buffertime` seconds, so detectFlexing
+        classifies the newest window without recording first.
+
+        window/hop: if hop is given, the reader thread also updates a sliding `window`-second
+        feature (default 0.5s) incrementally and appends (timestamp, mean) to self.powers
+        every `hop` seconds. detectFlexing then just compares the newest value.
+        """
+        if self.__streaming:
+            return
+        if self.source is not None:
+            raise StreamNotRunning('Streaming needs an RHX connection; offline sources are read with recordRead.')
+        # Raw uint16 samples and int32 frame timestamps, scaled when a window is read
+        self.ring = RingBuffer(int(buffertime / self.timestep), self._numChannels, self.timestep, self.featureDtype)
+        self.slidingPower = None
+        self.powers.clear()
+        if hop is not None:
+            window = 0.5 if window is None else window
+            # Window and hop are counted in (decimated) feature samples
+            step = self.timestep * self.decimation
+            self.slidingPower = SlidingPower(self.featureEngine, round(window / step),
+                                             round(hop / step), self._numChannels)
+            self.__streamDecimator = None
+            if self.decimation > 1:
+                self.__streamDecimator = Decimator(self.decimation, numChannels=self._numChannels,
+                                                   dtype=self.featureDtype)
+        self.__streaming = True
+        self.__streamThread = threading.Thread(target=self.__streamReader, daemon=True)
+        self._debugOut(f"Start streaming: buffertime={buffertime}")
+        self.__startRun()
+        self.__streamThread.start()
 
-        # Comptue CWT
-        coef, freq = self.computeCWT(data)
+    def stopStreaming(self):
+        if not self.__streaming:
+            return
+        self._debugOut("Stop streaming")
+        self.commands.setRunMode('stop')
+        self.__streaming = False
+        self.__streamThread.join()
+        self.__streamThread = None
+        if self.__recalibrator is not None:
+            self.__recalibrations.put(None)
+            self.__recalibrator.join()
+            self.__recalibrator = None
 
-        # Comput mean at object's freq
-        mean = np.mean(np.abs(coef[self.focusfreq]))
-        self.__debugOut(f"Sample Mean Power: {mean}")
+    def labelSegment(self, mode, seconds, start=None):
+        """Online recalibration while streaming: labels `seconds` of the stream as 'resting' or
+        'flexing', starting now or at RHX time `start` (seconds, e.g. a marker's timestamp; may be
+        in the past while still in the ring buffer). A background thread waits for the segment,
+        computes its power and swaps in the new flexThresh; detectFlexing never waits for it.
 
-        return mean > self.flexThresh
+        Segments not relabeled yet keep their last calibration mean, so relabeling only resting
+        is enough to follow a drifting baseline. Returns the RHX time the segment starts at.
+        """
+        if not self.__streaming:
+            raise StreamNotRunning('labelSegment requires startStreaming() to be called first.')
+        mode = mode.capitalize()
+        if mode not in ("Resting", "Flexing"):
+            raise ValueError("mode must be 'resting' or 'flexing'")
+        if start is None or self.__streamStart is None:
+            first = self.ring.total
+        else:
+            first = round((start - self.__streamStart) / self.timestep)
+        if self.__recalibrator is None:
+            self.__recalibrations = queue.Queue()
+            self.__recalibrator = threading.Thread(target=self.__recalibrate, daemon=True)
+            self.__recalibrator.start()
+        self.__recalibrations.put((mode, first, round(seconds / self.timestep)))
+        self._debugOut(f"Labeled {seconds}s of {mode} from sample {first}")
+        return None if self.__streamStart is None else self.__streamStart + first * self.timestep
+
+    def __recalibrate(self):
+        while True:
+            request = self.__recalibrations.get()
+            if request is None:
+                return
+            mode, first, numSamples = request
+            try:
+                # Wait for the rest of the segment to be streamed
+                timestamps, data = self.ring.read(first, numSamples, timeout=numSamples * self.timestep + 1)
+            except (TimeoutError, ValueError) as e:
+                print(f"Skipped {mode} segment for recalibration: {e}")
+                continue
+            self.__onlinePowers[mode] = self.computeFocusPower(data)
+            self._debugOut(f"Online Mean {mode} Power: ", self.__onlinePowers[mode])
+
+            resting = self.__onlinePowers.get("Resting", getattr(self, 'restingPower', None))
+            flexing = self.__onlinePowers.get("Flexing", getattr(self, 'flexingPower', None))
+            if resting is None or flexing is None:
+                continue
+            self.restingPower, self.flexingPower = resting, flexing
+            # One attribute assignment: decisions see either the old or the new threshold
+            self.flexThresh = resting + (flexing - resting) * self.threshRatio
+            print("Recalibrated threshold for Flexing classification: ", self.flexThresh)
+
+    def latestWindow(self, seconds, timeout=None, out=None):
+        """Returns the newest `seconds` of streamed (timestamps, data). Waits until that much
+        data has been buffered (default: up to `seconds` + 1 second).
+
+        out: optional (timestamps, data) arrays to fill instead of returning new ones.
+        """
+        if not self.__streaming:
+            raise StreamNotRunning('latestWindow requires startStreaming() to be called first.')
+        timeout = seconds + 1 if timeout is None else timeout
+        return self.ring.latest(round(seconds / self.timestep), timeout=timeout, out=out)
+
+    def latestPower(self, timeout=1):
+        """Returns the newest sliding (timestamp, mean power), waiting up to `timeout` seconds
+        for the first one.
+        """
+        if not self.__streaming or self.slidingPower is None:
+            raise StreamNotRunning('latestPower requires startStreaming(hop=...) to be called first.')
+        with self.__powerCond:
+            if not self.__powerCond.wait_for(lambda: len(self.powers) > 0, timeout):
+                raise TimeoutError('No sliding window power was computed in time.')
+            return self.powers[-1]
+
+    def popDecisions(self):
+        """Returns [(timestamp, flex)] for every sliding window emitted since the last call.
+        """
+        with self.__powerCond:
+            powers = list(self.powers)
+            self.powers.clear()
+        return [(timestamp, mean > self.flexThresh) for timestamp, mean in powers]
+
+    def __streamReader(self):
+        reader = self.__waveReader()
+        self.__streamStart = None
+        while self.__streaming:
+            try:
+                with self.__stage('stream.recv'):
+                    # Polls, so stopStreaming is noticed once RHX stops sending
+                    rawData = reader.readAvailable(minBlocks=1, timeout=STREAM_POLL)
+            except socket.timeout:
+                continue
+            except WaveformConnectionClosed:
+                self._debugOut("Waveform socket closed by server")
+                break
+            if not len(rawData):
+                continue
+            with self.__stage('stream.decode'):
+                frames, samples = decodeWaveformBlocks(rawData, self.timestep, self.frames_per_block,
+                                                       self._numChannels, raw=True)
+                self.ring.write(frames, samples)
+            if self.continuity.update(frames):
+                self._debugOut(f"Stream gap: {self.continuity.recentGaps[-1][1]} samples lost "
+                                f"({self.continuity.lostSamples} total)")
+            capture = self.capture
+            if capture is not None:
+                # Only queued: the capture's writer thread does the disk write
+                with self.__stage('stream.capture'):
+                    capture.write(rawData)
+            if self.__streamStart is None:
+                self.__streamStart = frames[0] * self.timestep
+                self.__clockOffset = self.__runStart - self.__streamStart
+
+            if self.slidingPower is not None:
+                with self.__stage('stream.sliding'):
+                    # Scale into a reused scratch buffer (power-of-two sizes)
+                    n = samples.shape[-1]
+                    scratch = self.__streamBuffers.get('stream', samples.shape[:-1] + (1 << (n - 1).bit_length(),), self.featureDtype)
+                    data = toMicroVolts(samples, self.featureDtype, out=scratch[..., :n])
+                    if self.__streamDecimator is not None:
+                        data = self.__streamDecimator.process(data)
+                    indices, means = self.slidingPower.push(data)
+                if len(means):
+                    with self.__powerCond:
+                        # Feature sample k is input sample k * decimation
+                        self.powers.extend(zip(self.__streamStart + indices * self.decimation * self.timestep, means.T))
+                        self.__powerCond.notify_all()
+        self.__streaming = False
 
     def recordRead(self, recordtime):
-        self.record(recordtime)
-        return self.readWaveform(recordtime)
+        """Runs the controller until `recordtime` seconds of blocks have been read, then stops it.
+        """
+        if self.source is not None:
+            return self.source.read(recordtime)
+        with self.__stage('record.start'):
+            self._debugOut("Start recording")
+            self.__startRun()
+        try:
+            # Returns as soon as the last block arrives; no sleep or idle wait after it
+            return self.readWaveform(recordtime)
+        finally:
+            with self.__stage('record.stop'):
+                self._debugOut("Stop recording")
+                self.commands.setRunMode('stop')
 
     def record(self, recordtime):
-        self.__debugOut("Start recording")
-        self.cmd.sendall(b'set runmode run')
-        sleep(recordtime)
-        self.__debugOut("Stop recording")
-        self.cmd.sendall(b'set runmode stop')
+        with self.__stage('record'):
+            self._debugOut("Start recording")
+            self.__startRun()
+            sleep(recordtime)
+            self._debugOut("Stop recording")
+            self.commands.setRunMode('stop')
+
+    def __startRun(self):
+        # Blocks a previous run sent past its last read are stale now
+        dropped = self.__waveReader().discard()
+        if dropped:
+            self._debugOut(f"Dropped {dropped} bytes left over from the previous run")
+        self.__runStart, self.__clockOffset = monotonic(), None
+        self.continuity.restart()
+        self.commands.setRunMode('run')
     
     def readWaveform(self, recordtime):
-        waveformBytesPerFrame = 4 + 2
-        waveformBytesPerBlock = self.frames_per_block * waveformBytesPerFrame + 4    # 4 bytes = magic number;
+        """Returns (timestamps, data) of the next ceil(recordtime / block duration) blocks;
+        blocks past them stay for the next read. Waits until they have arrived, so the controller
+        must still be running (see recordRead). data is 1-D for a single channel, (channels,
+        samples) when setup was given a list of channels.
+        """
+        blockSize = waveformBytesPerBlock(self.frames_per_block, len(self._channels))
+        numBlocks = -(-round(recordtime / self.timestep) // self.frames_per_block)
         
-        # Read waveform data
-        rawData = self.wave.recv(self.buffersize * (int(recordtime + 1)))
-        self.__debugOut("Raw data length:", len(rawData)) # Note: Each second at 30Hz = 129696 data points
-        self.__debugOut("Waveform Bytes Per Block:", waveformBytesPerBlock)
-        if len(rawData) % waveformBytesPerBlock != 0:
-            raise InvalidReceivedDataSize(
-                'An unexpected amount of data arrived that is not an integer '
-                'multiple of the expected data size per block.'
-            )
-        numBlocks = int(len(rawData) / waveformBytesPerBlock)
-        self.__debugOut("# Blocks:", numBlocks)
-
-        # Index used to read the raw data that came in through the TCP socket.
-        rawIndex = 0
-
-        # List used to contain scaled timestamp values in seconds.
-        amplifierTimestamps = []
+        # Read exactly the blocks covering recordtime
+        with self.__stage('readWaveform.recv'):
+            rawData = self.__waveReader().readBlocks(numBlocks)
+        self._debugOut("Raw data length:", len(rawData)) # Note: Each second at 30Hz = 129696 data points
+        self._debugOut("Waveform Bytes Per Block:", blockSize)
+        self._debugOut("# Blocks:", numBlocks)
 
-        # List used to contain scaled amplifier data in microVolts.
-        amplifierData = []
+        # Decode all blocks at once. See decodeWaveformBlocksReference for the per-frame loop.
+        with self.__stage('readWaveform.decode'):
+            frames, samples = decodeWaveformBlocks(rawData, self.timestep, self.frames_per_block, self._numChannels,
+                                                   raw=True)
+            timestamps, data = frames * self.timestep, toMicroVolts(samples, self.featureDtype)
+        lost = self.continuity.update(frames)
+        if lost:
+            self._debugOut(f"{lost} samples lost in this read ({self.continuity.gaps} gaps so far)")
+        if self.capture is not None:
+            self.capture.write(rawData)
+        if self.__clockOffset is None and self.__runStart is not None and len(timestamps):
+            self.__clockOffset = self.__runStart - timestamps[0]
+        return timestamps, data
 
-        for _ in range(numBlocks):
-            # Expect 4 bytes to be TCP Magic Number as uint32.
-            # If not what's expected, raise an exception.
-            magicNumber, rawIndex = readUint32(rawData, rawIndex)
-            if magicNumber != 0x2ef07a08:
-                raise InvalidMagicNumber('Error... magic number incorrect')
-
-            # Each block should contain 128 frames of data - process each
-            # of these one-by-one
-            for _ in range(self.frames_per_block):
-                # Expect 4 bytes to be timestamp as int32.
-                rawTimestamp, rawIndex = readInt32(rawData, rawIndex)
+    def readBlocks(self, numBlocks):
+        """Reads exactly numBlocks waveform blocks and decodes them.
+        """
+        rawData = self.__waveReader().readBlocks(numBlocks)
+        frames, samples = decodeWaveformBlocks(rawData, self.timestep, self.frames_per_block, self._numChannels,
+                                               raw=True)
+        self.continuity.update(frames)
+        return frames * self.timestep, toMicroVolts(samples, self.featureDtype)
 
-                # Multiply by 'timestep' to convert timestamp to seconds
-                amplifierTimestamps.append(rawTimestamp * self.timestep)
+    def streamStats(self):
+        """Waveform stream health, for sizing rcvbuf, buffertime and windows from real data:
+        frames: frames checked; gaps, lostSamples, lostSeconds, largestGap: forward jumps in the
+            RHX timestamps and the samples missing across them; resets: backward jumps;
+            recentGaps: (frame timestamp after the gap, samples lost) of the newest gaps.
+        rcvbuf: SO_RCVBUF granted by the OS. backlog: bytes waiting in the socket now (how far
+            the reader is behind RHX). readBacklog, maxBacklog: bytes waiting when the last and
+            fullest read started. Byte counts are None offline or without FIONREAD (Windows).
+        """
+        stats = self.continuity.stats()
+        stats['lostSeconds'] = stats['lostSamples'] * self.timestep if stats['lostSamples'] else 0.0
+        stats['rcvbuf'] = self.rcvbuf
+        reader = self.__blockReader
+        stats['backlog'] = None if self.source is not None else socketBytesWaiting(self.wave)
+        stats['readBacklog'] = None if reader is None else reader.backlog
+        stats['maxBacklog'] = None if reader is None else reader.maxBacklog
+        return stats
 
-                # Expect 2 bytes of wideband data.
-                rawSample, rawIndex = readUint16(rawData, rawIndex)
+    def resetStreamStats(self):
+        self.continuity.reset()
+        if self.__blockReader is not None:
+            self.__blockReader.maxBacklog = None
 
-                # Scale this sample to convert to microVolts
-                amplifierData.append(0.195 * (rawSample - 32768))
-                
-        return np.array(amplifierTimestamps), np.array(amplifierData)
+    def __waveReader(self):
+        # (Re)create the framing reader if frames_per_block or the channels changed
+        blockSize = waveformBytesPerBlock(self.frames_per_block, len(self._channels))
+        if self.__blockReader is None or self.__blockReader.blockSize != blockSize:
+            self.__blockReader = BlockReader(self.wave, blockSize, self.buffersize)
+        return self.__blockReader
 
     def computeCWT(self, data):
-        scales = np.arange(1, 128, 4)
-        self.__debugOut("Scale:", scales)
+        """Full CWT over all scales. Only used for viewing/debugging; classification uses
+        computeFocusPower.
+        """
+        self._debugOut("Scale:", self.scales)
+
+        with self.__stage('computeCWT'):
+            return pywt.cwt(data, self.scales, self.wavelet)
 
-        return pywt.cwt(data, scales, self.wavelet)
+    def computeFocusPower(self, data):
+        """The selected feature of the window. For 'cwt', mean |CWT| at scale
+        `scales[focusfreq]`; same value as np.mean(np.abs(computeCWT(data)[0][focusfreq]))
+        (approximately, after decimation). One value per channel for (channels, samples) data.
+        """
+        with self.__stage('computeFocusPower'):
+            return self.featurePower(data)
     
     def viewCWT(self, coefs):
         plt.figure(figsize=(12, 6))
@@ -243,26 +619,22 @@ class IntanInterface:
         
     
     def activateChannel(self, override=False):
-        if self.__setup_lock and not override:
-            raise ChannelChangeReject(
-                'Reject action to re-active/change channel. Doing this does not re-setup/calibrate.\nIf you are sure of this, use override=True.'
-            )
+        # Clear all outputs, then activate channel(s) to switch to this object's channel(s).
+        # Sent as one batch; returns once RHX has processed all of them.
+        commands = self.channelCommands(override)
+        self._debugOut("Clearing All Data Outputs")
+        self.commands.execute(*commands)
         
-        # Clear all outputs
-        self.__debugOut("Clearing All Data Outputs")
-        self.cmd.sendall(b'execute clearalldataoutputs')
-        sleep(0.1)
+        for channel in self._channels:
+            print(f"Activated channel A-%03.f" % channel)
         
-        # Activate channel to switch to this object's channel
-        fullCmd = f"set a-%03.f.tcpdataoutputenabled true" % self.__channel
-        self.cmd.sendall(bytes(fullCmd, 'utf-8'))
-        sleep(0.1)
-        
-        print(f"Activated channel A-%03.f" % self.__channel)
-        
-    def __debugOut(self, *args):
-        if self.__debug:
-            print("[DEBUG]", *args)
+    def __stage(self, stage):
+        # Shared no-op context when timings are off
+        return NO_TIMING if self.timings is None else self.timings.stage(stage)
+
+    def __observe(self, stage, start):
+        if self.timings is not None:
+            self.timings.observe(stage, perf_counter() - start)
 
 if __name__ == "__main__":
     interface = IntanInterface(('127.0.0.1', 5000), ('127.0.0.1', 5001), debug=True)
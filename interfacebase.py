@@ -0,0 +1,225 @@
+#########################################
+#   Interface Base
+#
+#   The protocol-independent part of IntanInterface and AsyncIntanInterface: setup options and
+#   channel selection, the feature engine, the calibration threshold and calibration profiles.
+#   The subclasses add the RHX I/O (blocking sockets or asyncio streams) around it.
+#
+
+import os
+import json
+from time import time
+from interfaceutils import *
+from featureengine import Decimator, makeExtractor, autoDecimation
+import numpy as np
+
+# Settings of profiles saved before they were recorded
+PROFILE_DEFAULTS = {'feature': 'cwt', 'featureOptions': {}, 'decimation': 1}
+
+
+class IntanInterfaceBase:
+    def __init__(self, debug=False):
+        # Init immutable constants.
+        self._debug = debug
+        self._setupLock = False
+        self._channels = [0]
+        self._numChannels = None    # None = single channel (1-D data), else len(channels)
+        self.continuity = FrameContinuity()     # Dropped samples in the waveform stream
+        self.decimator = None
+        self.featureEngine = None
+
+        # Init any mutable constant vars NOTE: Change here to reflect to all objects, or change externally for single object
+        self.buffersize = 200000
+        self.frames_per_block = 128
+        self.wavelet = 'mexh'
+        self.scales = np.arange(1, 128, 4)
+        self.threshRatio = 0.75
+        self.feature = 'cwt'    # Feature extractor name (featureengine.FEATURE_EXTRACTORS)
+        self.featureOptions = {}    # Extractor options, e.g. {'band': (20, 450)} for bandpower
+        self.decimation = 1     # Anti-aliased decimation factor before the feature (see buildFeatureEngine)
+        self.profileDir = 'profiles'
+        self.featureDtype = np.float32  # Streamed samples and feature math; np.float64 for full precision
+
+    def applySetup(self, kwargs):
+        """Checks the setup lock and takes the channel and feature options of setup(**kwargs).
+        Returns (recordtime, channel).
+        """
+        override = False if 'override' not in kwargs else kwargs['override']
+        if self._setupLock and not override:
+            self._debugOut("Re-setup blocked by setup lock. To re-setup, use override=True.")
+            raise SetupReplaceReject(
+                'Reject action to re-setup/calibrate an IntanInterface object.'
+            )
+
+        recordtime = 1 if 'recordtime' not in kwargs else kwargs['recordtime']
+        channel = 0 if 'channel' not in kwargs else kwargs['channel']
+        self.focusfreq = 25 if 'focusfreq' not in kwargs else kwargs['focusfreq']
+        channels = list(channel) if isinstance(channel, (list, tuple)) else [channel]
+        if isinstance(self.focusfreq, (list, tuple)):
+            if len(self.focusfreq) != len(channels):
+                raise ValueError(f"Got {len(self.focusfreq)} focusfreqs for {len(channels)} channels.")
+            # Each channel keeps its own focusfreq through the sort below
+            pairs = sorted(zip(channels, self.focusfreq), key=lambda pair: pair[0])
+            channels, self.focusfreq = [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+        # RHX sends the samples of each frame in channel order
+        self._channels = sorted(channels)
+        self._numChannels = len(self._channels) if isinstance(channel, (list, tuple)) else None
+        self.feature = kwargs.get('feature', self.feature)
+        self.featureOptions = kwargs.get('featureoptions', self.featureOptions)
+        self.decimation = kwargs.get('decimation', self.decimation)
+        self._debugOut(f"Setup: recordtime={recordtime}, channel={channel}, focusfreq={self.focusfreq}, "
+                       f"feature={self.feature}, decimation={self.decimation}")
+        return recordtime, channel
+
+    def applyCalibrate(self, kwargs):
+        """Checks the setup lock for calibrate(**kwargs). Returns its recordtime.
+        """
+        override = False if 'override' not in kwargs else kwargs['override']
+        if self._setupLock and not override:
+            self._debugOut("Re-calibration blocked by setup lock. To re-calibrate, use override=True.")
+            raise ChannelChangeReject(
+                'Reject action to change channel.'
+            )
+
+        recordtime = 1 if 'recordtime' not in kwargs else kwargs['recordtime']
+        self._debugOut(f"Calibration: recordtime={recordtime}, threshRatio={self.threshRatio}")
+        return recordtime
+
+    def setThreshold(self, calibrations):
+        """Flexing threshold threshRatio of the way from the resting to the flexing mean power.
+        """
+        self.restingPower, self.flexingPower = calibrations['Resting'], calibrations['Flexing']
+        threshDiff = (calibrations['Flexing'] - calibrations['Resting']) * self.threshRatio
+        self.flexThresh = calibrations['Resting'] + threshDiff
+        print("Threshold for Flexing classification: ", self.flexThresh)
+
+    def warnLost(self, lost, mode):
+        if lost:
+            print(f"Warning: {lost} samples ({lost * self.timestep:.3f}s) were dropped during {mode} calibration. "
+                  f"Consider a larger rcvbuf or a shorter recordtime.")
+
+    def channelCommands(self, override=False):
+        """The batch that clears all outputs and enables this object's channel(s).
+        """
+        if self._setupLock and not override:
+            raise ChannelChangeReject(
+                'Reject action to re-active/change channel. Doing this does not re-setup/calibrate.\nIf you are sure of this, use override=True.'
+            )
+        commands = ['execute clearalldataoutputs']
+        commands += [f"set a-%03.f.tcpdataoutputenabled true" % channel for channel in self._channels]
+        return commands
+
+    def buildFeatureEngine(self):
+        """(Re)builds the feature extractor (for 'cwt', the single-scale kernel). Call again
+        after changing feature, featureOptions, wavelet, scales, focusfreq or decimation
+        externally. Needs the sample rate (self.timestep).
+
+        With decimation q the feature runs at 1/q of the sample rate. The CWT kernel is built for
+        scale scales[focusfreq] / q (same frequency in Hz) with a sqrt(q) gain, so powers and
+        thresholds stay comparable to the undecimated ones. A focusfreq per channel builds a
+        MultiChannelCWT. decimation='auto' is resolved here for the selected feature (see
+        featureengine.autoDecimation).
+        """
+        if self.decimation == 'auto':
+            self.decimation = autoDecimation(self.feature, 1 / self.timestep,
+                                             scale=self.scales[np.asarray(self.focusfreq)], **self.featureOptions)
+            self._debugOut(f"Decimation: {self.decimation}")
+        q = self.decimation
+        self.decimator = Decimator(q, dtype=self.featureDtype) if q > 1 else None
+        self.featureEngine = makeExtractor(self.feature, 1 / self.timestep, q, self.featureDtype, wavelet=self.wavelet,
+                                           scale=self.scales[np.asarray(self.focusfreq)], **self.featureOptions)
+
+    def featurePower(self, data):
+        """The selected feature of the window (decimated first). One value per channel for
+        (channels, samples) data.
+        """
+        if self.decimator is not None:
+            data = self.decimator.decimate(data)
+        return self.featureEngine.meanPower(data)
+
+    def profilePath(self, name=None):
+        """Calibration profiles are keyed by electrode/channel, e.g. profiles/right-A-023.json.
+        """
+        key = "_".join(f"A-%03.f" % channel for channel in self._channels)
+        return os.path.join(self.profileDir, key if name is None else f"{name}-{key}") + '.json'
+
+    def profileSettings(self):
+        """The feature settings a calibration is only valid for, as saved in a profile.
+        """
+        def plain(value):
+            return np.asarray(value).tolist()
+        return {
+            'wavelet': self.wavelet, 'scales': plain(self.scales), 'focusfreq': plain(self.focusfreq),
+            'threshRatio': self.threshRatio, 'feature': self.feature, 'featureOptions': self.featureOptions,
+            'decimation': self.decimation,
+        }
+
+    def saveProfile(self, name=None):
+        """Saves the current calibration. Returns the profile path.
+        """
+        def plain(value):
+            return np.asarray(value).tolist()
+        profile = {
+            'channel': list(self._channels), 'sampleRate': 1 / self.timestep, **self.profileSettings(),
+            'restingPower': plain(self.restingPower), 'flexingPower': plain(self.flexingPower),
+            'flexThresh': plain(self.flexThresh), 'savedAt': time(),
+        }
+        path = self.profilePath(name)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(profile, file, indent=1)
+        self._debugOut(f"Saved calibration profile {path}")
+        return path
+
+    def loadProfile(self, name=None, maxage=None):
+        """Reads a saved calibration without applying it. Returns the profile, or None if there is
+        none for these channels, it is older than `maxage` seconds, was recorded at another sample
+        rate or with other feature settings (profileSettings) than the current ones.
+        """
+        path = self.profilePath(name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            profile = json.load(file)
+        if maxage is not None and time() - profile['savedAt'] > maxage:
+            self._debugOut(f"Calibration profile {path} is older than {maxage}s")
+            return None
+        if profile['channel'] != self._channels or abs(profile['sampleRate'] * self.timestep - 1) > 1e-6:
+            self._debugOut(f"Calibration profile {path} does not match the channels/sample rate")
+            return None
+        # Compared as saved, e.g. tuples in featureOptions become lists
+        settings = json.loads(json.dumps(self.profileSettings()))
+        mismatched = [key for key, value in settings.items() if profile.get(key, PROFILE_DEFAULTS.get(key)) != value]
+        if mismatched:
+            self._debugOut(f"Calibration profile {path} was made with other {', '.join(mismatched)}")
+            return None
+
+        for key in ('restingPower', 'flexingPower', 'flexThresh'):
+            if isinstance(profile[key], list):
+                profile[key] = np.asarray(profile[key])
+        self._debugOut(f"Read calibration profile {path}")
+        return profile
+
+    def applyProfile(self, profile):
+        """Uses a profile's calibration (see loadProfile; its settings are the current ones).
+        """
+        self.restingPower, self.flexingPower, self.flexThresh = (
+            profile['restingPower'], profile['flexingPower'], profile['flexThresh'])
+
+    def matchesProfile(self, mean, profile, tolerance=0.5):
+        """Whether a resting power lies within `tolerance` of the profile's resting-to-threshold gap
+        of its resting mean.
+        """
+        resting, flexThresh = profile['restingPower'], profile['flexThresh']
+        valid = bool(np.all(np.abs(mean - resting) <= tolerance * (flexThresh - resting)))
+        self._debugOut(f"Validation Mean Power: {mean}, saved resting {resting}: {valid}")
+        if not valid:
+            print("Saved calibration does not match, recalibrating.")
+        return valid
+
+    def getChannels(self):
+        return list(self._channels)
+
+    def _debugOut(self, *args):
+        if self._debug:
+            print("[DEBUG]", *args)
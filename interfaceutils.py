@@ -1,3 +1,10 @@
+import select
+import socket
+import threading
+import numpy as np
+from collections import deque
+from time import perf_counter
+
 #########################################
 #   Interface Utils (User Defined)
 #
@@ -17,20 +24,38 @@ class ChannelChangeReject(Exception):
     This is a warning error that is thrown as it'll greatly affect recording.
     """
 
+class StreamNotRunning(Exception):
+    """Exception returned when streamed data is requested from an IntanInterface object
+    that has not been put in streaming mode with startStreaming().
+    """
+
 #########################################
 #   Intan Utils (Defined by Intan Software)
 #
 
+MAGIC_NUMBER = 0x2ef07a08
+MICROVOLTS_PER_BIT = 0.195
+
 class GetSampleRateFailure(Exception):
     """Exception returned when the TCP socket failed to yield the sample rate
     as reported by the RHX software.
     """
 
+class CommandError(Exception):
+    """Exception returned when the RHX software replies to a command with an error,
+    or a query does not get the expected Return.
+    """
+
 class InvalidMagicNumber(Exception):
     """Exception returned when the first 4 bytes of a data block are not the
     expected RHX TCP magic number (0x2ef07a08).
     """
 
+class WaveformConnectionClosed(Exception):
+    """Exception returned when the TCP waveform socket is closed while waiting for
+    data blocks.
+    """
+
 class InvalidReceivedDataSize(Exception):
     """Exception returned when the amount of data received on the TCP socket
     is not an integer multiple of the excepted data block size.
@@ -61,4 +86,512 @@ def readUint16(array, arrayIndex):
     variableBytes = array[arrayIndex: arrayIndex + 2]
     variable = int.from_bytes(variableBytes, byteorder='little', signed=False)
     arrayIndex = arrayIndex + 2
-    return variable, arrayIndex
\ No newline at end of file
+    return variable, arrayIndex
+
+
+#########################################
+#   Waveform Block Decoding
+#
+
+def waveformBytesPerBlock(framesPerBlock=128, numChannels=1):
+    """Size of one RHX waveform block: 4 byte magic number, then per frame a 4 byte
+    timestamp followed by one 2 byte sample per enabled channel.
+    """
+    return framesPerBlock * (4 + 2 * numChannels) + 4
+
+
+def waveformBlockDtype(framesPerBlock=128, numChannels=1):
+    """NumPy structured dtype for one RHX waveform block: the uint32 magic number
+    followed by `framesPerBlock` frames of {int32 timestamp, numChannels x uint16 sample}.
+    """
+    frameDtype = np.dtype([('timestamp', '<i4'), ('samples', '<u2', (numChannels,))])
+    return np.dtype([('magic', '<u4'), ('frames', frameDtype, (framesPerBlock,))])
+
+
+def toMicroVolts(raw, dtype=np.float32, out=None):
+    """Scales uint16 amplifier samples to microVolts in one pass (into `out` if given).
+    """
+    out = np.subtract(raw, 32768, dtype=dtype, out=out)
+    out *= MICROVOLTS_PER_BIT
+    return out
+
+
+def decodeWaveformBlocks(rawData, timestep, framesPerBlock=128, numChannels=None, raw=False, dtype=np.float64):
+    """Decodes every block of rawData in one pass with a structured dtype view (no copy
+    of the receive buffer). All magic numbers are checked at once.
+
+    numChannels: number of enabled channels per frame. None decodes a single channel
+    into a 1-D array; an int returns a (numChannels, samples) array with rows in the
+    channel order of the frame.
+    raw: return the int32 frame timestamps and uint16 samples as they are (strided views
+    of rawData, valid as long as it is) and leave scaling to the consumer.
+    dtype: float type of the microVolt data. The float64 default matches
+    decodeWaveformBlocksReference exactly; np.float32 halves the output for compact math.
+
+    Returns: (timestamps in seconds, amplifier data in microVolts)
+    """
+    channels = 1 if numChannels is None else numChannels
+    blockDtype = waveformBlockDtype(framesPerBlock, channels)
+    if len(rawData) % blockDtype.itemsize != 0:
+        raise InvalidReceivedDataSize(
+            'An unexpected amount of data arrived that is not an integer '
+            'multiple of the expected data size per block.'
+        )
+    blocks = np.frombuffer(rawData, dtype=blockDtype)
+    if not np.all(blocks['magic'] == MAGIC_NUMBER):
+        raise InvalidMagicNumber('Error... magic number incorrect')
+
+    frames = blocks['frames']
+    samples = frames['samples'].reshape(-1, channels).T
+    if numChannels is None:
+        samples = samples[0]
+    if raw:
+        return frames['timestamp'].reshape(-1), samples
+    return frames['timestamp'].reshape(-1) * timestep, toMicroVolts(samples, dtype)
+
+
+def decodeWaveformBlocksReference(rawData, timestep, framesPerBlock=128):
+    """Reference decoder reading each block field by field. Kept to validate
+    decodeWaveformBlocks against; output is identical with dtype=np.float64.
+
+    Returns: (timestamps in seconds, amplifier data in microVolts)
+    """
+    blockSize = waveformBytesPerBlock(framesPerBlock)
+    if len(rawData) % blockSize != 0:
+        raise InvalidReceivedDataSize(
+            'An unexpected amount of data arrived that is not an integer '
+            'multiple of the expected data size per block.'
+        )
+    numBlocks = int(len(rawData) / blockSize)
+
+    # Index used to read the raw data that came in through the TCP socket.
+    rawIndex = 0
+
+    # List used to contain scaled timestamp values in seconds.
+    amplifierTimestamps = []
+
+    # List used to contain scaled amplifier data in microVolts.
+    amplifierData = []
+
+    for _ in range(numBlocks):
+        # Expect 4 bytes to be TCP Magic Number as uint32.
+        # If not what's expected, raise an exception.
+        magicNumber, rawIndex = readUint32(rawData, rawIndex)
+        if magicNumber != MAGIC_NUMBER:
+            raise InvalidMagicNumber('Error... magic number incorrect')
+
+        # Each block should contain 128 frames of data - process each
+        # of these one-by-one
+        for _ in range(framesPerBlock):
+            # Expect 4 bytes to be timestamp as int32.
+            rawTimestamp, rawIndex = readInt32(rawData, rawIndex)
+
+            # Multiply by 'timestep' to convert timestamp to seconds
+            amplifierTimestamps.append(rawTimestamp * timestep)
+
+            # Expect 2 bytes of wideband data.
+            rawSample, rawIndex = readUint16(rawData, rawIndex)
+
+            # Scale this sample to convert to microVolts
+            amplifierData.append(0.195 * (rawSample - 32768))
+
+    return np.array(amplifierTimestamps), np.array(amplifierData)
+
+
+#########################################
+#   Streaming Ring Buffer
+#
+
+class RingBuffer:
+    """Fixed-size circular buffer holding the most recent `capacity` samples and their
+    timestamps. Written by the stream reader thread and read by the decision loop.
+
+    numChannels: None stores 1-D samples, an int stores (numChannels, samples) rows.
+    timestep: store compactly instead: write() takes raw int32 frame timestamps and uint16
+    samples (decodeWaveformBlocks(raw=True)); reads scale them to seconds and `dtype`
+    microVolts. 6 bytes per sample instead of 16.
+    """
+    def __init__(self, capacity, numChannels=None, timestep=None, dtype=np.float32):
+        self.capacity = int(capacity)
+        self.timestep = timestep
+        self.dtype = dtype
+        shape = self.capacity if numChannels is None else (numChannels, self.capacity)
+        if timestep is None:
+            self.timestamps = np.zeros(self.capacity)
+            self.data = np.zeros(shape)
+        else:
+            self.timestamps = np.zeros(self.capacity, dtype=np.int32)
+            self.data = np.zeros(shape, dtype=np.uint16)
+        self.total = 0  # Total number of samples ever written
+        self.__cond = threading.Condition()
+
+    def write(self, timestamps, data):
+        n = len(timestamps)
+        if n == 0:
+            return
+        if n > self.capacity:
+            # Only the newest `capacity` samples can be kept
+            timestamps, data = timestamps[-self.capacity:], data[..., -self.capacity:]
+            skipped, n = n - self.capacity, self.capacity
+        else:
+            skipped = 0
+
+        with self.__cond:
+            start = (self.total + skipped) % self.capacity
+            first = min(n, self.capacity - start)
+            self.timestamps[start:start + first] = timestamps[:first]
+            self.data[..., start:start + first] = data[..., :first]
+            # Wrap around to the front of the buffer
+            self.timestamps[:n - first] = timestamps[first:]
+            self.data[..., :n - first] = data[..., first:]
+            self.total += skipped + n
+            self.__cond.notify_all()
+
+    def latest(self, n, timeout=None, out=None):
+        """Returns copies of the newest n (timestamps, data) in time order. Waits up to
+        `timeout` seconds for n samples to be available (None = wait forever).
+
+        out: optional (timestamps, data) arrays to copy into instead of allocating, e.g.
+        from a BufferPool.
+        """
+        n = int(n)
+        if n > self.capacity:
+            raise ValueError(f'Requested {n} samples but ring buffer only holds {self.capacity}.')
+
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.total >= n, timeout):
+                raise TimeoutError(f'Only {self.total} of {n} requested samples arrived in time.')
+            return self.__copy(self.total - n, n, out)
+
+    def read(self, start, n, timeout=None):
+        """Returns copies of samples [start, start + n), counted from the first sample ever
+        written. Waits up to `timeout` seconds for them to arrive; raises ValueError if they
+        were already overwritten.
+        """
+        start, n = int(start), int(n)
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.total >= start + n, timeout):
+                raise TimeoutError(f'Samples up to {start + n} did not arrive in time ({self.total} so far).')
+            if start < self.total - self.capacity:
+                raise ValueError(f'Samples from {start} were already overwritten.')
+            return self.__copy(start, n, None)
+
+    def __copy(self, start, n, out):
+        # At most two contiguous pieces; scaled into the output when stored compactly
+        begin = start % self.capacity
+        first = min(n, self.capacity - begin)
+        if out is None:
+            timestampType = float if self.timestep is not None else self.timestamps.dtype
+            dataType = self.dtype if self.timestep is not None else self.data.dtype
+            out = (np.empty(n, dtype=timestampType), np.empty(self.data.shape[:-1] + (n,), dtype=dataType))
+        timestamps, data = out
+        for target, source in ((slice(0, first), slice(begin, begin + first)), (slice(first, n), slice(0, n - first))):
+            if self.timestep is None:
+                timestamps[target] = self.timestamps[source]
+                data[..., target] = self.data[..., source]
+            else:
+                np.multiply(self.timestamps[source], self.timestep, out=timestamps[target])
+                toMicroVolts(self.data[..., source], data.dtype, out=data[..., target])
+        return timestamps, data
+
+    def clear(self):
+        with self.__cond:
+            self.total = 0
+
+
+class BufferPool:
+    """Reusable arrays keyed by (name, shape, dtype), so steady-state loops (same window
+    size every decision) stop allocating. At most `maxBuffers` are kept; the least recently
+    used is dropped when a new size shows up.
+
+    An array handed out for a key is handed out again for the next request of that key, so
+    it must not be kept past that. Not thread-safe: give each thread its own pool.
+    """
+    def __init__(self, maxBuffers=16):
+        self.maxBuffers = maxBuffers
+        self.__buffers = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        key = (name, tuple(np.atleast_1d(shape)), np.dtype(dtype))
+        buffer = self.__buffers.pop(key, None)
+        if buffer is None:
+            buffer = np.empty(key[1], dtype=dtype)
+            if len(self.__buffers) >= self.maxBuffers:
+                self.__buffers.pop(next(iter(self.__buffers)))
+        self.__buffers[key] = buffer    # Most recently used last
+        return buffer
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.__buffers.values())
+
+
+#########################################
+#   Waveform Socket Framing
+#
+
+class BlockReader:
+    """Reads whole waveform blocks from a socket into one preallocated buffer with recv_into.
+    Bytes past the last whole block are carried over to the next read, so TCP may split
+    blocks anywhere.
+
+    The memoryview returned by a read is only valid until the next read.
+    """
+    def __init__(self, sock, blockSize, capacity=200000):
+        self.sock = sock
+        self.blockSize = blockSize
+        self.buffer = bytearray(max(capacity - capacity % blockSize, blockSize))
+        self.view = memoryview(self.buffer)
+        self.filled = 0     # Bytes received into the buffer
+        self.consumed = 0   # Bytes handed out by the last read
+        self.backlog = None     # Bytes waiting in the socket when the last read started
+        self.maxBacklog = None
+
+    def readBlocks(self, numBlocks):
+        """Blocks until exactly numBlocks whole blocks are available and returns them.
+        """
+        self.__compact()
+        self.__measureBacklog()
+        need = numBlocks * self.blockSize
+        self.__reserve(need)
+        while self.filled < need:
+            self.__recv()
+        self.consumed = need
+        return self.view[:need]
+
+    def readAvailable(self, minBlocks=1, idle=0, timeout=None):
+        """Returns every whole block that has arrived, waiting for at least minBlocks.
+        Afterwards keeps reading while more data arrives within `idle` seconds.
+
+        timeout: return an empty view (keeping any partial block) when no data arrives within
+        `timeout` seconds while waiting for minBlocks, e.g. to poll a stop flag.
+        """
+        self.__compact()
+        self.__measureBacklog()
+        while self.filled < minBlocks * self.blockSize:
+            if timeout is not None and not select.select([self.sock], [], [], timeout)[0]:
+                return self.view[:0]
+            self.__recv()
+        while select.select([self.sock], [], [], idle)[0]:
+            if self.filled == len(self.buffer):
+                self.__reserve(2 * len(self.buffer))
+            self.__recv()
+        self.consumed = self.filled - self.filled % self.blockSize
+        return self.view[:self.consumed]
+
+    def pending(self):
+        """Number of bytes buffered but not yet returned (at most a partial block after a read).
+        """
+        return self.filled - self.consumed
+
+    def discard(self):
+        """Drops everything buffered and already waiting in the socket, e.g. the blocks a
+        previous run sent past the last read. Returns the number of bytes dropped.
+        """
+        dropped, self.filled, self.consumed = self.filled - self.consumed, 0, 0
+        while select.select([self.sock], [], [], 0)[0]:
+            received = self.sock.recv_into(self.view)
+            if received == 0:
+                raise WaveformConnectionClosed('Waveform socket was closed by the server.')
+            dropped += received
+        return dropped
+
+    def __measureBacklog(self):
+        # How far behind RHX the reader is: bytes the kernel holds that we have not read yet
+        self.backlog = socketBytesWaiting(self.sock)
+        if self.backlog is not None and (self.maxBacklog is None or self.backlog > self.maxBacklog):
+            self.maxBacklog = self.backlog
+
+    def __recv(self):
+        if self.filled == len(self.buffer):
+            self.__reserve(len(self.buffer) + self.blockSize)
+        received = self.sock.recv_into(self.view[self.filled:])
+        if received == 0:
+            raise WaveformConnectionClosed('Waveform socket was closed by the server.')
+        self.filled += received
+
+    def __compact(self):
+        # Move the carried-over partial block to the front of the buffer
+        if self.consumed:
+            leftover = self.filled - self.consumed
+            self.view[:leftover] = self.view[self.consumed:self.filled]
+            self.filled = leftover
+            self.consumed = 0
+
+    def __reserve(self, size):
+        # Grow (rarely) when a read needs more room than the buffer has
+        if size <= len(self.buffer):
+            return
+        size += -size % self.blockSize
+        buffer = bytearray(size)
+        buffer[:self.filled] = self.view[:self.filled]
+        self.buffer, self.view = buffer, memoryview(buffer)
+
+
+def socketBytesWaiting(sock):
+    """Bytes received by the kernel but not yet read from sock (FIONREAD), or None where
+    the platform has no FIONREAD ioctl for sockets (Windows).
+    """
+    try:
+        import fcntl
+        import termios
+    except ImportError:
+        return None
+    count = bytearray(4)
+    try:
+        fcntl.ioctl(sock.fileno(), termios.FIONREAD, count)
+    except OSError:
+        return None
+    return int.from_bytes(count, 'little' if np.little_endian else 'big', signed=True)
+
+
+def setReceiveBuffer(sock, size):
+    """Requests a `size` byte socket receive buffer (SO_RCVBUF) and returns the size the OS
+    actually granted. Linux doubles the request for bookkeeping and caps it at
+    net.core.rmem_max, so compare against the return value rather than `size`. Set it
+    before connect() so TCP can advertise a window that large.
+    """
+    if size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(size))
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+class FrameContinuity:
+    """Checks that consecutive RHX frame timestamps are contiguous. Every frame is one tick
+    after the previous one, so a jump forward means RHX dropped or overran samples (e.g. a
+    reader that fell behind while its receive buffer was full) and a jump back means the
+    timestamps were reset.
+
+    update() takes the int32 frame timestamps of each read in order; restart() forgets the
+    last timestamp (call it when a new run starts, so the pause between runs is not a gap).
+    """
+    def __init__(self, maxGaps=64):
+        self.recentGaps = deque(maxlen=maxGaps)     # (timestamp after the gap, lost samples)
+        self.reset()
+
+    def reset(self):
+        self.frames = 0         # Frames checked
+        self.gaps = 0           # Forward jumps
+        self.lostSamples = 0    # Frames missing across all forward jumps
+        self.largestGap = 0
+        self.resets = 0         # Backward jumps
+        self.recentGaps.clear()
+        self.last = None
+
+    def restart(self):
+        self.last = None
+
+    def update(self, timestamps):
+        """Counts the discontinuities in one read of int32 frame timestamps and returns the
+        number of samples lost in it.
+        """
+        n = len(timestamps)
+        if n == 0:
+            return 0
+        timestamps = np.asarray(timestamps, dtype=np.int32)
+        self.frames += n
+        first, self.last = self.last, int(timestamps[-1])
+        # int32 arithmetic, so the wraparound from 2**31 - 1 to -2**31 is still a step of 1
+        steps = np.diff(timestamps)
+        jumps = np.flatnonzero(steps != 1)
+        step = 1 if first is None else (int(timestamps[0]) - first + 2**31) % 2**32 - 2**31
+        if step == 1 and len(jumps) == 0:
+            return 0
+        lost = 0 if step == 1 else self.__jump(step, timestamps[0])
+        for i in jumps:
+            lost += self.__jump(int(steps[i]), timestamps[i + 1])
+        return lost
+
+    def stats(self):
+        return {'frames': self.frames, 'gaps': self.gaps, 'lostSamples': self.lostSamples,
+                'largestGap': self.largestGap, 'resets': self.resets, 'recentGaps': list(self.recentGaps)}
+
+    def __jump(self, step, timestamp):
+        if step <= 0:
+            self.resets += 1
+            return 0
+        missing = step - 1
+        self.gaps += 1
+        self.lostSamples += missing
+        self.largestGap = max(self.largestGap, missing)
+        self.recentGaps.append((int(timestamp), missing))
+        return missing
+
+
+#########################################
+#   Latency Instrumentation
+#
+
+class LatencyRecorder:
+    """Rolling latency samples per stage: the newest `capacity` durations (seconds) of every
+    stage are kept in a preallocated array, percentiles are only computed on snapshot().
+
+    name: label for the snapshot, e.g. the arm this interface serves.
+    """
+    def __init__(self, name=None, capacity=1024):
+        self.name = name
+        self.capacity = capacity
+        self.__samples = {}
+        self.__counts = {}
+        self.__lock = threading.Lock()
+
+    def stage(self, stage):
+        """Context manager timing the enclosed block as `stage`.
+        """
+        return _StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        samples = self.__samples.get(stage)
+        if samples is None:
+            with self.__lock:
+                samples = self.__samples.setdefault(stage, np.zeros(self.capacity))
+                self.__counts.setdefault(stage, 0)
+        samples[self.__counts[stage] % self.capacity] = seconds
+        self.__counts[stage] += 1
+
+    def snapshot(self):
+        """{'name', 'stages': {stage: {count, mean, p50, p95, p99, max}}} in seconds, over the
+        newest `capacity` samples of each stage.
+        """
+        with self.__lock:
+            stages = list(self.__samples)
+        summary = {}
+        for stage in stages:
+            count = self.__counts[stage]
+            samples = self.__samples[stage][:min(count, self.capacity)].copy()
+            p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+            summary[stage] = {'count': count, 'mean': float(samples.mean()), 'p50': float(p50),
+                              'p95': float(p95), 'p99': float(p99), 'max': float(samples.max())}
+        return {'name': self.name, 'stages': summary}
+
+    def export(self, path):
+        import json
+        with open(path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=1)
+
+    def reset(self):
+        with self.__lock:
+            self.__samples.clear()
+            self.__counts.clear()
+
+    def format(self):
+        lines = [f"Latency{'' if self.name is None else ' (' + str(self.name) + ')'} [ms]:",
+                 f"  {'stage':<28} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}"]
+        for stage, s in self.snapshot()['stages'].items():
+            lines.append(f"  {stage:<28} {s['count']:>7} " + " ".join(
+                f"{s[key] * 1e3:>9.3f}" for key in ('mean', 'p50', 'p95', 'p99', 'max')))
+        return "\n".join(lines)
+
+
+class _StageTimer:
+    __slots__ = ('recorder', 'stage', 'start')
+
+    def __init__(self, recorder, stage):
+        self.recorder = recorder
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.recorder.observe(self.stage, perf_counter() - self.start)
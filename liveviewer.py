@@ -0,0 +1,389 @@
+#########################################
+#   Live Viewer
+#
+#   Non-blocking debug view of the acquisition: a separate process computes and draws the |CWT|
+#   spectrogram and the power/threshold/decision traces at a fixed frame rate. The acquisition
+#   side only copies new raw samples and trace points into a shared-memory ring and never waits
+#   for the viewer. Like controloutput, the ring is guarded by a sequence counter (odd while
+#   being written), so the viewer retries instead of reading a half-written update.
+#
+#   Without a display (or with an output directory) frames are rendered to a PNG file instead
+#   of a window.
+#
+#   Layout: uint64 header[8] | float64 sampleTimes[sampleCapacity] | float64 traceTimes[traceCapacity]
+#           | float32 samples[sampleCapacity] | float32 power, threshold, decision
+#           [traceCapacity, numChannels] each
+#
+
+import os
+import sys
+import multiprocessing as mp
+import numpy as np
+from time import monotonic, sleep
+from multiprocessing import shared_memory
+
+# header: sequence, samples written, traces written, sampleCapacity, traceCapacity, numChannels
+SEQ, SAMPLES, TRACES, SAMPLE_CAPACITY, TRACE_CAPACITY, CHANNELS = range(6)
+HEADER_FIELDS = 8
+
+
+def hasDisplay():
+    """False on Linux/BSD sessions without an X11 or Wayland display.
+    """
+    if sys.platform.startswith(('win', 'darwin')):
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def bufferSize(sampleCapacity, traceCapacity, numChannels):
+    return 8 * (HEADER_FIELDS + sampleCapacity + traceCapacity) + 4 * (sampleCapacity
+                                                                       + 3 * traceCapacity * numChannels)
+
+
+def mapBuffer(buf, sampleCapacity, traceCapacity, numChannels):
+    """numpy views of the ring in a shared-memory buffer: (header, sampleTimes, traceTimes,
+    samples, power, threshold, decision).
+    """
+    views, offset = [], 0
+    for dtype, shape in ((np.uint64, (HEADER_FIELDS,)), (np.float64, (sampleCapacity,)),
+                         (np.float64, (traceCapacity,)), (np.float32, (sampleCapacity,)),
+                         (np.float32, (traceCapacity, numChannels)), (np.float32, (traceCapacity, numChannels)),
+                         (np.float32, (traceCapacity, numChannels))):
+        view = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        views.append(view)
+        offset += view.nbytes
+    return views
+
+
+def restartIndex(times):
+    """Index of the first sample after the last backward jump in times (0 if there is none),
+    i.e. where the newest run of RHX timestamps starts.
+    """
+    jumps = np.flatnonzero(np.diff(times) < 0)
+    return int(jumps[-1]) + 1 if len(jumps) else 0
+
+
+class SpectrogramWriter:
+    """Acquisition side. Owns the shared-memory ring.
+
+    sampleCapacity/traceCapacity: raw samples and trace points kept. numChannels: values per
+    trace point.
+    """
+    def __init__(self, sampleCapacity=100000, traceCapacity=1000, numChannels=1, name=None):
+        self.name = f"intan_viewer_{os.getpid()}" if name is None else name
+        self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=bufferSize(
+            sampleCapacity, traceCapacity, numChannels))
+        (self.header, self.sampleTimes, self.traceTimes, self.samples,
+         self.power, self.threshold, self.decision) = mapBuffer(self.shm.buf, sampleCapacity,
+                                                                traceCapacity, numChannels)
+        self.header[:] = 0
+        self.header[[SAMPLE_CAPACITY, TRACE_CAPACITY, CHANNELS]] = (sampleCapacity, traceCapacity, numChannels)
+
+    def writeSamples(self, times, samples):
+        """Appends raw samples of the viewed channel: times (n,) and samples (n,).
+        """
+        capacity = self.samples.shape[0]
+        count = min(len(times), capacity)
+        if count == 0:
+            return
+        start = (int(self.header[SAMPLES]) + len(times) - count) % capacity
+        first = min(count, capacity - start)
+        self.header[SEQ] += 1
+        # At most two contiguous pieces
+        self.sampleTimes[start:start + first] = times[len(times) - count:len(times) - count + first]
+        self.samples[start:start + first] = samples[len(times) - count:len(times) - count + first]
+        self.sampleTimes[:count - first] = times[len(times) - count + first:]
+        self.samples[:count - first] = samples[len(times) - count + first:]
+        self.header[SAMPLES] += len(times)
+        self.header[SEQ] += 1
+
+    def writeTrace(self, time, power, threshold, decision):
+        """Appends one decision: the feature, threshold and decision per channel.
+        """
+        row = int(self.header[TRACES]) % self.traceTimes.shape[0]
+        self.header[SEQ] += 1
+        self.traceTimes[row] = time
+        self.power[row], self.threshold[row], self.decision[row] = power, threshold, decision
+        self.header[TRACES] += 1
+        self.header[SEQ] += 1
+
+    def close(self, unlink=True):
+        # Drop the numpy views first, SharedMemory.close fails while they are alive
+        del self.header, self.sampleTimes, self.traceTimes, self.samples, self.power, self.threshold, self.decision
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class SpectrogramReader:
+    """Viewer side: attach by name, then poll() for what was written since the last poll.
+    Meant for the process LiveViewer starts.
+    """
+    def __init__(self, name):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13: LiveViewer's process shares the writer's resource tracker, which
+            # already tracks the ring and unlinks it once with the writer
+            self.shm = shared_memory.SharedMemory(name=name)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.uint64, buffer=self.shm.buf)
+        self.sampleCapacity, self.traceCapacity, self.numChannels = (
+            int(value) for value in header[[SAMPLE_CAPACITY, TRACE_CAPACITY, CHANNELS]])
+        del header
+        (self.header, self.sampleTimes, self.traceTimes, self.samples,
+         self.power, self.threshold, self.decision) = mapBuffer(self.shm.buf, self.sampleCapacity,
+                                                                self.traceCapacity, self.numChannels)
+        self.samplesRead = self.tracesRead = 0
+
+    def poll(self):
+        """Returns (sampleTimes, samples, traceTimes, power, threshold, decision) with only the
+        samples and trace points written since the last call (at most one ring each).
+        """
+        while True:
+            seq = int(self.header[SEQ])
+            if seq % 2:
+                sleep(0)
+                continue
+            samplesWritten, tracesWritten = int(self.header[SAMPLES]), int(self.header[TRACES])
+            sampleRows = np.arange(max(self.samplesRead, samplesWritten - self.sampleCapacity),
+                                   samplesWritten) % self.sampleCapacity
+            traceRows = np.arange(max(self.tracesRead, tracesWritten - self.traceCapacity), tracesWritten) % self.traceCapacity
+            update = (self.sampleTimes[sampleRows], self.samples[sampleRows], self.traceTimes[traceRows],
+                      self.power[traceRows], self.threshold[traceRows], self.decision[traceRows])
+            # Retry if the writer was mid-update
+            if int(self.header[SEQ]) == seq:
+                self.samplesRead, self.tracesRead = samplesWritten, tracesWritten
+                return update
+
+    def close(self):
+        del self.header, self.sampleTimes, self.traceTimes, self.samples, self.power, self.threshold, self.decision
+        self.shm.close()
+
+
+class ColumnBuilder:
+    """Viewer side |CWT| columns from raw samples: each push() transforms only the new samples
+    plus the widest kernel's half width of history around them, so columns are not edge
+    affected, and returns the new columns, each the mean |coef| over `block` samples. A column
+    is held back until that half width of samples after it has arrived.
+    Timestamps going backwards (RHX restarted them) start over from the new run.
+    """
+    def __init__(self, scales, wavelet='mexh', block=1):
+        self.scales = np.asarray(scales)
+        self.wavelet = wavelet
+        self.block = block
+        import pywt
+        self.margin = int(np.ceil(pywt.ContinuousWavelet(wavelet).upper_bound * np.max(self.scales)))
+        self.reset()
+
+    def reset(self):
+        self.times = np.empty(0)
+        self.values = np.empty(0, dtype=np.float32)
+        self.consumed = 0   # Samples already turned into columns
+
+    def push(self, times, values):
+        """Returns (column times, columns (numScales, n)) and whether timestamps restarted.
+        """
+        import pywt
+        restarted = len(times) > 0 and (restartIndex(times) > 0 or (len(self.times) > 0 and times[0] < self.times[-1]))
+        if restarted:
+            self.reset()
+            first = restartIndex(times)
+            times, values = times[first:], values[first:]
+        self.times = np.concatenate((self.times, times))
+        self.values = np.concatenate((self.values, values))
+        numColumns = max(0, len(self.times) - self.margin - self.consumed) // self.block
+        if numColumns == 0:
+            return np.empty(0), np.empty((self.scales.size, 0)), restarted
+        end = self.consumed + numColumns * self.block
+        start = max(0, self.consumed - self.margin)
+        coef, freq = pywt.cwt(self.values[start:end + self.margin], self.scales, self.wavelet, method='fft')
+        columns = np.abs(coef[:, self.consumed - start:end - start]).reshape(
+            self.scales.size, numColumns, self.block).mean(axis=-1)
+        columnTimes = self.times[self.consumed + self.block - 1:end:self.block]
+        # Keep the margin of history and the samples of the next, still partial, column
+        keep = max(0, end - self.margin)
+        self.times, self.values = self.times[keep:], self.values[keep:]
+        self.consumed = end - keep
+        return columnTimes, columns, restarted
+
+
+def runViewer(name, scales, wavelet='mexh', block=1, columns=1000, fps=10, outdir=None,
+              title='Wavelet Power Spectrum of EMG Signal', stop=None):
+    """Viewer loop: redraws at `fps` frames/s until `stop` is set or the window is closed.
+    The |CWT| of new samples is computed here (see ColumnBuilder), `block` samples per column
+    and `columns` columns on screen. Only new columns and trace points are copied into the
+    already created image and lines.
+    With outdir (or without a display) each frame overwrites outdir/spectrogram.png.
+    """
+    import matplotlib
+    headless = outdir is not None or not hasDisplay()
+    if headless:
+        matplotlib.use('Agg')
+        outdir = 'viewer' if outdir is None else outdir
+        os.makedirs(outdir, exist_ok=True)
+    import matplotlib.pyplot as plt
+
+    reader = SpectrogramReader(name)
+    builder = ColumnBuilder(scales, wavelet, block)
+    numScales = builder.scales.size
+    image = np.zeros((numScales, columns), dtype=np.float32)
+    imageTimes = np.full(columns, np.nan)
+    traces = {key: np.full((reader.traceCapacity, reader.numChannels), np.nan, dtype=np.float32)
+              for key in ('power', 'threshold', 'decision')}
+    traceTimes = np.full(reader.traceCapacity, np.nan)
+
+    figure, (spectrum, levels) = plt.subplots(2, 1, figsize=(12, 8), sharex=True, height_ratios=(2, 1))
+    artist = spectrum.imshow(image, aspect='auto', cmap='jet', origin='lower', interpolation='nearest')
+    figure.colorbar(artist, ax=spectrum, label='Wavelet Power')
+    spectrum.set_ylabel('Scale index')
+    spectrum.set_title(title)
+    powerLines = levels.plot(traceTimes, traces['power'], label='power')
+    thresholdLines = levels.plot(traceTimes, traces['threshold'], '--', label='threshold')
+    decisionAxis = levels.twinx()
+    decisionLines = decisionAxis.plot(traceTimes, traces['decision'], drawstyle='steps-post', alpha=0.4)
+    decisionAxis.set_ylim(-0.1, 1.1)
+    decisionAxis.set_ylabel('Flexing')
+    levels.set_xlabel('Time (s, 0 = newest)')
+    levels.set_ylabel('Feature')
+    if not headless:
+        plt.show(block=False)
+
+    period = 1 / fps
+    nextFrame = monotonic()
+    while stop is None or not stop.is_set():
+        if not headless and not plt.fignum_exists(figure.number):
+            break
+        sampleTimes, samples, newTraceTimes, power, threshold, decision = reader.poll()
+        newTileTimes, newTiles, restarted = builder.push(sampleTimes, samples)
+        if restarted:
+            image[:] = 0
+            imageTimes[:] = np.nan
+        if len(newTraceTimes) and (restartIndex(newTraceTimes) or newTraceTimes[0] < traceTimes[-1]):
+            # Decisions of the new run only
+            first = restartIndex(newTraceTimes)
+            newTraceTimes, power, threshold, decision = (newTraceTimes[first:], power[first:],
+                                                         threshold[first:], decision[first:])
+            traceTimes[:] = np.nan
+            for values in traces.values():
+                values[:] = np.nan
+        if len(newTileTimes) or len(newTraceTimes) or restarted:
+            # Scroll left and append: only the new columns/points are copied
+            n = min(len(newTileTimes), columns)
+            newTileTimes, newTiles = newTileTimes[len(newTileTimes) - n:], newTiles[:, newTiles.shape[1] - n:]
+            if n:
+                image[:, :-n] = image[:, n:]
+                image[:, -n:] = newTiles
+                imageTimes[:-n] = imageTimes[n:]
+                imageTimes[-n:] = newTileTimes
+            n = len(newTraceTimes)
+            if n:
+                traceTimes[:-n] = traceTimes[n:]
+                traceTimes[-n:] = newTraceTimes
+                for key, values in (('power', power), ('threshold', threshold), ('decision', decision)):
+                    traces[key][:-n] = traces[key][n:]
+                    traces[key][-n:] = values
+
+            latest = np.concatenate((imageTimes[-1:], traceTimes[-1:]))
+            newest = 0 if np.all(np.isnan(latest)) else np.nanmax(latest)
+            artist.set_data(image)
+            first = np.nanmin(imageTimes) if not np.isnan(imageTimes[-1]) else np.nan
+            if first < imageTimes[-1]:
+                artist.set_extent((first - newest, imageTimes[-1] - newest, -0.5, numScales - 0.5))
+                artist.set_clim(0, max(float(np.max(image)), 1e-12))
+            for lines, key in ((powerLines, 'power'), (thresholdLines, 'threshold'), (decisionLines, 'decision')):
+                for channel, line in enumerate(lines):
+                    line.set_data(traceTimes - newest, traces[key][:, channel])
+            levels.relim()
+            levels.autoscale_view()
+            if headless:
+                path = os.path.join(outdir, 'spectrogram.png')
+                figure.savefig(path + '.tmp.png')
+                os.replace(path + '.tmp.png', path)
+            else:
+                figure.canvas.draw_idle()
+
+        nextFrame += period
+        if headless:
+            sleep(max(0, nextFrame - monotonic()))
+        else:
+            # Runs the GUI event loop while waiting for the next frame
+            plt.pause(max(0.001, nextFrame - monotonic()))
+        if nextFrame < monotonic():
+            nextFrame = monotonic()
+    reader.close()
+    plt.close(figure)
+
+
+class LiveViewer:
+    """A SpectrogramWriter plus the viewer process reading it. publish()/writeTrace() only copy
+    into the ring and never block; the viewer process computes the |CWT|. close() stops the
+    process and frees the ring.
+
+    columnRate: |CWT| columns per second of signal kept on screen for `seconds`.
+    bufferTime: seconds of raw samples the ring holds for a viewer that fell behind.
+    """
+    def __init__(self, scales, sampleRate, numChannels=1, seconds=10, columnRate=100, fps=10, outdir=None,
+                 wavelet='mexh', bufferTime=2):
+        self.scales = np.asarray(scales)
+        self.block = max(1, int(round(sampleRate / columnRate)))   # Samples averaged per column
+        self.writer = SpectrogramWriter(max(int(bufferTime * sampleRate), self.block), int(seconds * columnRate),
+                                        numChannels)
+        self.lastSampleTime = -np.inf
+        # spawn: the viewer must not inherit the acquisition's sockets, threads or plot backend
+        context = mp.get_context('spawn')
+        self.stop = context.Event()
+        self.process = context.Process(target=runViewer, daemon=True,
+                                       args=(self.writer.name, self.scales, wavelet, self.block,
+                                             int(seconds * columnRate), fps, outdir),
+                                       kwargs={'stop': self.stop})
+        self.process.start()
+
+    def publish(self, timestamps, data):
+        """Copies the samples of one channel newer than what was already published into the
+        ring. When the timestamps went backwards (RHX restarted them), the new run is published
+        from its start.
+        """
+        if len(timestamps) == 0:
+            return
+        first = 0
+        if timestamps[-1] < self.lastSampleTime or timestamps[0] > timestamps[-1]:
+            first = restartIndex(timestamps)
+            self.lastSampleTime = -np.inf
+        start = first + int(np.searchsorted(timestamps[first:], self.lastSampleTime, side='right'))
+        if start < len(timestamps):
+            self.writer.writeSamples(timestamps[start:], data[start:])
+            self.lastSampleTime = timestamps[-1]
+
+    def writeTrace(self, time, power, threshold, decision):
+        self.writer.writeTrace(time, power, threshold, decision)
+
+    def close(self, timeout=2):
+        self.stop.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.writer.close()
+
+
+if __name__ == "__main__":
+    # Demo: synthetic EMG through a viewer (headless runs write viewer/spectrogram.png)
+    import argparse
+    from rhxsimulator import syntheticEMG
+    parser = argparse.ArgumentParser(description='Live spectrogram viewer demo on synthetic EMG.')
+    parser.add_argument('--samplerate', type=float, default=10000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--fps', type=float, default=10)
+    parser.add_argument('--outdir', help='Render frames to this directory instead of a window')
+    args = parser.parse_args()
+
+    scales = np.arange(1, 128, 4)
+    data, flexing = syntheticEMG(args.samplerate, args.seconds)
+    viewer = LiveViewer(scales, args.samplerate, fps=args.fps, outdir=args.outdir)
+    window = int(0.25 * args.samplerate)
+    for end in range(window, data.size, window):
+        timestamps = np.arange(end - window, end) / args.samplerate
+        power = np.mean(np.abs(data[end - window:end]))
+        viewer.publish(timestamps, data[end - window:end])
+        viewer.writeTrace(timestamps[-1], power, 100, power > 100)
+        sleep(0.25)
+    viewer.close()
@@ -0,0 +1,180 @@
+#########################################
+#   Parameter Sweep
+#
+#   Grid search over IntanInterface.wavelet, scale sets, focusfreq and threshRatio against
+#   labeled segments of a recording. Each (wavelet, scale) cell's window powers are cached on
+#   disk under a key made from the signal's content hash and the cell parameters, so widening
+#   the grid only computes the new cells; threshRatio values never need a transform.
+#
+#   Output is a table ranked by accuracy, then by compute cost per decision.
+#
+
+import os
+import json
+import hashlib
+import multiprocessing as mp
+import numpy as np
+from time import perf_counter
+from featureengine import FocusScaleCWT
+from batchclassifier import windowPowers, thresholds, classify, windowLabels, loadSignal
+
+SCALE_SETS = {
+    'arange(1,128,4)': np.arange(1, 128, 4),
+    'arange(1,128,2)': np.arange(1, 128, 2),
+    'arange(1,64,2)': np.arange(1, 64, 2),
+    'logspace(0,7,32,base=2)': np.logspace(0, 7, 32, base=2),
+}
+
+_signal = None
+
+
+def signalHash(data):
+    return hashlib.sha1(np.ascontiguousarray(data).view(np.uint8)).hexdigest()
+
+
+def _initWorker(data):
+    global _signal
+    _signal = data
+
+
+def computeCell(cell, data=None):
+    """Transforms one (wavelet, scale) cell: calibration segment powers, test window powers and
+    the median time of one decision's feature computation.
+    """
+    data = _signal if data is None else data
+    engine = FocusScaleCWT(cell['wavelet'], cell['scale'])
+    rest = data[cell['resting'][0]:cell['resting'][1]]
+    flex = data[cell['flexing'][0]:cell['flexing'][1]]
+    test = data[cell['test'][0]:cell['test'][1]]
+    starts, powers = windowPowers(test, engine, cell['window'], cell['hop'], cell['mode'])
+
+    window = test[:cell['window']]
+    times = []
+    for _ in range(7):
+        start = perf_counter()
+        engine.meanPower(window)
+        times.append(perf_counter() - start)
+
+    return {
+        'restingPower': float(engine.meanPower(rest)), 'flexingPower': float(engine.meanPower(flex)),
+        'starts': starts.tolist(), 'powers': powers.tolist(), 'secondsPerDecision': float(np.median(times)),
+    }
+
+
+class ParameterSweep:
+    """source/channel: recording as for batchclassifier.evaluate. Segments are (start, end) in
+    seconds; flexingIntervals label the test windows.
+    """
+    def __init__(self, source, channel=0, resting=(0, 1), flexing=(1, 2), test=None, flexingIntervals=(),
+                 window=0.25, hop=None, mode='window', cacheDir='.sweepcache'):
+        self.data, self.sampleRate = loadSignal(source, channel)
+        self.hash = signalHash(self.data)
+        self.flexingIntervals = [tuple(interval) for interval in flexingIntervals]
+        self.cacheDir = cacheDir
+
+        def samples(bounds):
+            return [int(round(bounds[0] * self.sampleRate)), int(round(bounds[1] * self.sampleRate))]
+        test = (0, self.data.size / self.sampleRate) if test is None else test
+        self.base = {
+            'resting': samples(resting), 'flexing': samples(flexing), 'test': samples(test),
+            'window': int(round(window * self.sampleRate)),
+            'hop': int(round((window if hop is None else hop) * self.sampleRate)), 'mode': mode,
+        }
+
+    def cellKey(self, cell):
+        description = json.dumps({'signal': self.hash, **cell}, sort_keys=True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def run(self, wavelets=('mexh',), scaleSets=('arange(1,128,4)',), focusfreqs=(25,),
+            ratios=(0.25, 0.5, 0.75), processes=None):
+        """Returns result rows (dicts) ranked by accuracy then seconds per decision.
+        """
+        # Different scale sets / focusfreqs often land on the same scale; transform each once
+        combos = []
+        for wavelet in wavelets:
+            for scaleSet in scaleSets:
+                scales = SCALE_SETS[scaleSet] if isinstance(scaleSet, str) else np.asarray(scaleSet)
+                for focusfreq in focusfreqs:
+                    if focusfreq < len(scales):
+                        combos.append((wavelet, str(scaleSet), focusfreq, float(scales[focusfreq])))
+        cells = {}
+        for wavelet, scaleSet, focusfreq, scale in combos:
+            cell = dict(self.base, wavelet=wavelet, scale=scale)
+            cells[self.cellKey(cell)] = cell
+
+        results = {key: self.__loadCell(key) for key in cells}
+        missing = [key for key, result in results.items() if result is None]
+        print(f"{len(cells)} cells, {len(cells) - len(missing)} cached, computing {len(missing)}")
+        if missing:
+            if processes == 1 or len(missing) == 1:
+                computed = [computeCell(cells[key], self.data) for key in missing]
+            else:
+                with mp.Pool(processes, initializer=_initWorker, initargs=(self.data,)) as pool:
+                    computed = pool.map(computeCell, [cells[key] for key in missing], chunksize=1)
+            for key, result in zip(missing, computed):
+                self.__saveCell(key, result)
+                results[key] = result
+
+        rows = []
+        for wavelet, scaleSet, focusfreq, scale in combos:
+            result = results[self.cellKey(dict(self.base, wavelet=wavelet, scale=scale))]
+            flexThresh = thresholds(result['restingPower'], result['flexingPower'], ratios)
+            decisions = classify(result['powers'], flexThresh)
+            labels = windowLabels(np.asarray(result['starts']) + self.base['test'][0], self.base['window'],
+                                  self.sampleRate, self.flexingIntervals)
+            accuracy = np.mean(decisions == labels[None, :], axis=1)
+            for ratio, threshold, correct in zip(ratios, flexThresh, accuracy):
+                rows.append({
+                    'wavelet': wavelet, 'scaleSet': scaleSet, 'focusfreq': focusfreq, 'scale': scale,
+                    'threshRatio': ratio, 'flexThresh': float(threshold), 'accuracy': float(correct),
+                    'secondsPerDecision': result['secondsPerDecision'],
+                })
+        rows.sort(key=lambda row: (-row['accuracy'], row['secondsPerDecision']))
+        return rows
+
+    def __loadCell(self, key):
+        path = os.path.join(self.cacheDir, key + '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    def __saveCell(self, key, result):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        with open(os.path.join(self.cacheDir, key + '.json'), 'w') as file:
+            json.dump(result, file)
+
+
+def printTable(rows, limit=20):
+    print(f"{'rank':>4} {'wavelet':>12} {'scales':>24} {'focusfreq':>9} {'scale':>8} {'ratio':>6} {'accuracy':>9} {'us/decision':>12}")
+    for rank, row in enumerate(rows[:limit], 1):
+        print(f"{rank:>4} {row['wavelet']:>12} {row['scaleSet']:>24} {row['focusfreq']:>9} {row['scale']:>8.2f} "
+              f"{row['threshRatio']:>6.2f} {row['accuracy']:>9.3f} {row['secondsPerDecision'] * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Grid search wavelet, scales, focusfreq and threshRatio.')
+    parser.add_argument('recording', help='.rhd file')
+    parser.add_argument('--channel', type=int, default=0)
+    parser.add_argument('--resting', type=float, nargs=2, required=True, metavar=('START', 'END'))
+    parser.add_argument('--flexing', type=float, nargs=2, required=True, metavar=('START', 'END'))
+    parser.add_argument('--test', type=float, nargs=2, metavar=('START', 'END'))
+    parser.add_argument('--flex-interval', type=float, nargs=2, action='append', default=[],
+                        metavar=('START', 'END'), help='Labeled flexing interval (repeatable)')
+    parser.add_argument('--window', type=float, default=0.25)
+    parser.add_argument('--wavelets', nargs='+', default=['mexh', 'morl', 'gaus1', 'gaus2', 'cgau1', 'cmor1.5-1.0'])
+    parser.add_argument('--scalesets', nargs='+', default=['arange(1,128,4)'], choices=list(SCALE_SETS))
+    parser.add_argument('--focusfreqs', type=int, nargs='+', default=[5, 10, 15, 20, 25, 30])
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.25, 0.5, 0.6, 0.75, 0.9])
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--json', help='Also write all rows to this file')
+    args = parser.parse_args()
+
+    sweep = ParameterSweep(args.recording, args.channel, args.resting, args.flexing, args.test,
+                           args.flex_interval, args.window)
+    rows = sweep.run(args.wavelets, args.scalesets, args.focusfreqs, args.ratios, args.processes)
+    printTable(rows)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(rows, file, indent=1)
@@ -0,0 +1,240 @@
+#########################################
+#   RHD Recording Reader
+#
+#   Reads Intan .rhd recordings (the files in recordings/) without a live RHX session.
+#   The header is parsed once; data blocks are exposed through np.memmap so amplifier
+#   channels are only decoded when asked for. Decoded channels are cached on disk next to
+#   the recording (.rhdcache/) keyed by file size and mtime, so repeat runs skip both.
+#
+#   Format: "RHD2000 Application Note: Data File Formats" (Intan Technologies).
+#
+
+import os
+import json
+import struct
+import numpy as np
+from interfaceutils import toMicroVolts
+
+RHD_MAGIC_NUMBER = 0xc6912702
+
+
+class InvalidRHDFile(Exception):
+    """Exception returned when a file is not an .rhd recording (wrong magic number, or the
+    data section is not a whole number of data blocks).
+    """
+
+
+def readQString(fid):
+    """Reads a Qt QString: uint32 byte length (0xFFFFFFFF = empty) then UTF-16LE text.
+    """
+    length, = struct.unpack('<I', fid.read(4))
+    if length == 0xFFFFFFFF:
+        return ""
+    return fid.read(length).decode('utf-16-le')
+
+
+def readHeader(fid):
+    """Parses the .rhd header from an open file. Returns a JSON-serialisable dict; fid is
+    left at the start of the data blocks.
+    """
+    magicNumber, = struct.unpack('<I', fid.read(4))
+    if magicNumber != RHD_MAGIC_NUMBER:
+        raise InvalidRHDFile('Unrecognized file type: .rhd magic number incorrect.')
+
+    header = {}
+    major, minor = struct.unpack('<hh', fid.read(4))
+    header['version'] = [major, minor]
+    header['sampleRate'], = struct.unpack('<f', fid.read(4))
+    (header['dspEnabled'], header['actualDspCutoffFrequency'], header['actualLowerBandwidth'],
+     header['actualUpperBandwidth'], header['desiredDspCutoffFrequency'], header['desiredLowerBandwidth'],
+     header['desiredUpperBandwidth']) = struct.unpack('<hffffff', fid.read(26))
+    header['notchFilterMode'], = struct.unpack('<h', fid.read(2))
+    header['desiredImpedanceTestFrequency'], header['actualImpedanceTestFrequency'] = struct.unpack('<ff', fid.read(8))
+    header['notes'] = [readQString(fid) for _ in range(3)]
+
+    header['numTempSensorChannels'] = 0
+    if (major, minor) >= (1, 1):
+        header['numTempSensorChannels'], = struct.unpack('<h', fid.read(2))
+    header['evalBoardMode'] = 0
+    if (major, minor) >= (1, 3):
+        header['evalBoardMode'], = struct.unpack('<h', fid.read(2))
+    header['referenceChannel'] = ''
+    if major > 1:
+        header['referenceChannel'] = readQString(fid)
+    header['samplesPerBlock'] = 128 if major >= 3 else 60
+
+    # Channels by signal type: 0 amplifier, 1 aux input, 2 supply voltage, 3 board ADC,
+    # 4 board digital in, 5 board digital out
+    signalTypes = ['amplifier', 'auxInput', 'supplyVoltage', 'boardAdc', 'boardDigIn', 'boardDigOut']
+    for signalType in signalTypes:
+        header[signalType + 'Channels'] = []
+
+    numSignalGroups, = struct.unpack('<h', fid.read(2))
+    for group in range(numSignalGroups):
+        groupName = readQString(fid)
+        groupPrefix = readQString(fid)
+        enabled, numChannels, numAmpChannels = struct.unpack('<hhh', fid.read(6))
+        if numChannels <= 0 or not enabled:
+            continue
+        for _ in range(numChannels):
+            channel = {'portName': groupName, 'portPrefix': groupPrefix}
+            channel['nativeChannelName'] = readQString(fid)
+            channel['customChannelName'] = readQString(fid)
+            (channel['nativeOrder'], channel['customOrder'], signalType, channelEnabled,
+             channel['chipChannel'], channel['boardStream']) = struct.unpack('<hhhhhh', fid.read(12))
+            fid.read(8)     # Spike scope trigger settings
+            channel['impedanceMagnitude'], channel['impedancePhase'] = struct.unpack('<ff', fid.read(8))
+            if channelEnabled:
+                header[signalTypes[signalType] + 'Channels'].append(channel)
+
+    header['headerSize'] = fid.tell()
+    return header
+
+
+def blockDtype(header):
+    """Structured dtype of one .rhd data block, so the data section can be memory-mapped.
+    """
+    samples = header['samplesPerBlock']
+    timestampType = '<i4' if tuple(header['version']) >= (1, 2) else '<u4'
+    fields = [('timestamps', timestampType, (samples,))]
+    sizes = [
+        ('amplifier', len(header['amplifierChannels']), samples),
+        ('auxInput', len(header['auxInputChannels']), samples // 4),
+        ('supplyVoltage', len(header['supplyVoltageChannels']), 1),
+        ('tempSensor', header['numTempSensorChannels'], 1),
+        ('boardAdc', len(header['boardAdcChannels']), samples),
+    ]
+    for name, numChannels, numSamples in sizes:
+        if numChannels > 0:
+            fields.append((name, '<u2', (numChannels, numSamples)))
+    # Digital inputs/outputs are packed as one uint16 word per sample
+    if header['boardDigInChannels']:
+        fields.append(('boardDigIn', '<u2', (samples,)))
+    if header['boardDigOutChannels']:
+        fields.append(('boardDigOut', '<u2', (samples,)))
+    return np.dtype(fields)
+
+
+class RHDReader:
+    """Lazy reader for one .rhd recording.
+
+    cacheDir: where decoded channels and the parsed header are kept (default: .rhdcache next
+    to the recording). None disables the cache with cache=False.
+    """
+    def __init__(self, path, cacheDir=None, cache=True):
+        self.path = path
+        stat = os.stat(path)
+        self.cacheDir = None
+        if cache:
+            cacheDir = os.path.join(os.path.dirname(os.path.abspath(path)), '.rhdcache') if cacheDir is None else cacheDir
+            key = f"{os.path.basename(path)}-{stat.st_size}-{int(stat.st_mtime_ns)}"
+            self.cacheDir = os.path.join(cacheDir, key)
+
+        self.header = self.__loadHeader()
+        self.sampleRate = self.header['sampleRate']
+        self.timestep = 1 / self.sampleRate
+        self.dtype = blockDtype(self.header)
+
+        dataBytes = stat.st_size - self.header['headerSize']
+        if dataBytes % self.dtype.itemsize != 0:
+            raise InvalidRHDFile('Data section is not a whole number of data blocks.')
+        self.numBlocks = dataBytes // self.dtype.itemsize
+        self.numSamples = self.numBlocks * self.header['samplesPerBlock']
+        self.__blocks = None
+
+    def blocks(self):
+        """Memory-mapped data blocks (nothing is read until fields are accessed).
+        """
+        if self.__blocks is None:
+            self.__blocks = np.memmap(self.path, dtype=self.dtype, mode='r',
+                                      offset=self.header['headerSize'], shape=(self.numBlocks,))
+        return self.__blocks
+
+    def channelNames(self):
+        return [channel['nativeChannelName'] for channel in self.header['amplifierChannels']]
+
+    def channelIndex(self, channel):
+        """Row of an amplifier channel given its native name ('A-023') or RHX channel number on
+        port A (23). Raises ValueError if the recording does not have the channel.
+        """
+        name = channel if isinstance(channel, str) else f"A-%03.f" % channel
+        names = self.channelNames()
+        if name not in names:
+            raise ValueError(f"Channel {name} is not in {self.path} (channels: {', '.join(names)}).")
+        return names.index(name)
+
+    def timestamps(self):
+        """Timestamps in seconds for every sample.
+        """
+        return self.__cached('timestamps', lambda: self.blocks()['timestamps'].reshape(-1) * self.timestep)
+
+    def amplifier(self, channel=None, row=None):
+        """Amplifier data of one channel in float32 microVolts, decoded once and then cached
+        on disk. row: select by position among the recorded channels instead of by channel.
+        """
+        index = self.channelIndex(channel) if row is None else row
+        def decode():
+            return toMicroVolts(self.blocks()['amplifier'][:, index, :].reshape(-1))
+        return self.__cached(f"amplifier-{index:03d}-f4", decode)
+
+    def __cached(self, name, decode):
+        if self.cacheDir is None:
+            return decode()
+        path = os.path.join(self.cacheDir, name + '.npy')
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+        data = decode()
+        os.makedirs(self.cacheDir, exist_ok=True)
+        np.save(path, data)
+        return data
+
+    def __loadHeader(self):
+        path = None if self.cacheDir is None else os.path.join(self.cacheDir, 'header.json')
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                return json.load(file)
+        with open(self.path, 'rb') as fid:
+            header = readHeader(fid)
+        if path is not None:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            with open(path, 'w') as file:
+                json.dump(header, file)
+        return header
+
+
+class RecordingSource:
+    """Offline stand-in for the TCP waveform source of an IntanInterface: read(seconds) returns
+    the next `seconds` of (timestamps, data) from a recording, the same shapes readWaveform
+    returns, and seek(seconds) moves the cursor.
+    """
+    def __init__(self, reader, channel=0, start=0):
+        # reader: .rhd path, RHDReader, or anything with its interface (streamcapture.CaptureReader)
+        self.reader = RHDReader(reader) if isinstance(reader, str) else reader
+        self.sampleRate = self.reader.sampleRate
+        self.timestep = self.reader.timestep
+        self.select(channel)
+        self.seek(start)
+
+    def select(self, channel):
+        """channel: int/name for 1-D data, or a list for (channels, samples) data.
+        """
+        self.channel = channel
+        self.__multi = isinstance(channel, (list, tuple))
+        channels = sorted(channel) if self.__multi else [channel]
+        self.__data = [self.reader.amplifier(c) for c in channels]
+
+    def seek(self, seconds):
+        self.position = int(round(seconds * self.sampleRate))
+
+    def tell(self):
+        return self.position * self.timestep
+
+    def read(self, seconds):
+        start = self.position
+        end = min(start + int(round(seconds * self.sampleRate)), self.reader.numSamples)
+        if end <= start:
+            raise EOFError('End of recording.')
+        self.position = end
+        timestamps = np.asarray(self.reader.timestamps()[start:end])
+        rows = [np.asarray(data[start:end]) for data in self.__data]
+        return timestamps, (np.stack(rows) if self.__multi else rows[0])
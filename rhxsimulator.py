@@ -0,0 +1,256 @@
+#########################################
+#   RHX Simulator
+#
+#   Local stand-in for the Intan RHX software's TCP command and waveform servers, so
+#   IntanInterface can be run and benchmarked without hardware. Streams correctly framed
+#   waveform blocks (magic number, int32 timestamps, uint16 samples for every enabled
+#   channel) from synthetic EMG or from .rhd recordings, at real time or accelerated.
+#
+
+import re
+import socket
+import threading
+import numpy as np
+from time import monotonic, sleep
+from interfaceutils import MAGIC_NUMBER, waveformBlockDtype
+
+
+def syntheticEMG(sampleRate=10000, seconds=10, period=5, restUV=20, flexUV=150, seed=0):
+    """Alternating resting/flexing EMG-like noise in microVolts: `period` seconds of low
+    amplitude noise, then `period` seconds of high amplitude band-limited bursts.
+
+    Returns: (data, flexing) where flexing is the per-sample ground truth label.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(sampleRate * seconds)
+    flexing = (np.arange(n) // int(period * sampleRate)) % 2 == 1
+    noise = rng.normal(size=n)
+    # Smooth the flexing noise so its power sits at lower frequencies like motor unit bursts
+    kernel = np.hanning(max(3, int(sampleRate / 500)))
+    burst = np.convolve(rng.normal(size=n), kernel / np.sqrt(np.sum(kernel ** 2)), mode='same')
+    data = np.where(flexing, flexUV * burst, restUV * noise)
+    return data, flexing
+
+
+class SignalSource:
+    """Per-channel signal for the simulator. Channels not in `signals` get `default`; every
+    signal loops when it runs out. Signals are in microVolts.
+    """
+    def __init__(self, signals=None, default=None):
+        self.signals = {} if signals is None else {channel: np.asarray(signal) for channel, signal in signals.items()}
+        self.default = default
+
+    @classmethod
+    def fromRecording(cls, reader):
+        """Serves the amplifier channels of an .rhd recording (rhdreader.RHDReader) or a stream
+        capture (streamcapture.CaptureReader) under their port A channel numbers, e.g. A-023 as
+        channel 23.
+        """
+        signals = {}
+        for index, name in enumerate(reader.channelNames()):
+            number = int(name.split('-')[-1]) if name.upper().startswith('A-') else index
+            signals[number] = reader.amplifier(row=index)
+        return cls(signals)
+
+    def samples(self, channel, start, count):
+        signal = self.signals.get(channel, self.default)
+        if signal is None:
+            return np.zeros(count)
+        return np.take(signal, np.arange(start, start + count), mode='wrap')
+
+
+class RHXSimulator:
+    """Serves the RHX command port and waveform port on localhost.
+
+    Commands: get runmode, get sampleratehertz, set runmode run|stop,
+    execute clearalldataoutputs, set a-NNN.tcpdataoutputenabled true|false. Several commands
+    may be sent in one string separated by ';'.
+
+    speed: 1 streams in real time, N streams N times faster, None as fast as the socket allows.
+    """
+    def __init__(self, source=None, sampleRate=10000, cmdPort=5000, wavePort=5001, host='127.0.0.1',
+                 speed=1, framesPerBlock=128, debug=False):
+        if source is None:
+            data, flexing = syntheticEMG(sampleRate)
+            source = SignalSource(default=data)
+        self.source = source
+        self.sampleRate = sampleRate
+        self.speed = speed
+        self.framesPerBlock = framesPerBlock
+        self.debug = debug
+
+        self.running = False
+        self.enabled = set()
+        self.timestamp = 0      # Next frame's timestamp
+        self.blocksSent = 0
+        self.bytesSent = 0
+        self.commands = 0
+        self.__lock = threading.Lock()
+        self.__closing = False
+
+        self.cmdServer = socket.create_server((host, cmdPort))
+        self.waveServer = socket.create_server((host, wavePort))
+        self.cmdAddrPort = self.cmdServer.getsockname()
+        self.waveAddrPort = self.waveServer.getsockname()
+        self.__threads = []
+
+    def start(self):
+        for target in (self.__serveCommands, self.__serveWaveform):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+        return self
+
+    def close(self):
+        self.__closing = True
+        self.running = False
+        for server in (self.cmdServer, self.waveServer):
+            server.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def handle(self, command):
+        """Executes one command string and returns the reply (or None if there is none).
+        """
+        command = command.strip()
+        self.commands += 1
+        lower = command.lower()
+        if lower == 'get runmode':
+            return f"Return: RunMode {'Run' if self.running else 'Stop'}"
+        if lower == 'get sampleratehertz':
+            return f"Return: SampleRateHertz {self.sampleRate:g}"
+        if lower == 'set runmode run':
+            self.running = True
+            return None
+        if lower == 'set runmode stop':
+            self.running = False
+            return None
+        if lower == 'execute clearalldataoutputs':
+            with self.__lock:
+                self.enabled.clear()
+            return None
+        match = re.fullmatch(r'set a-(\d{3})\.tcpdataoutputenabled (true|false)', lower)
+        if match:
+            if self.running:
+                return "Error: TCP data output cannot be changed while running"
+            with self.__lock:
+                if match.group(2) == 'true':
+                    self.enabled.add(int(match.group(1)))
+                else:
+                    self.enabled.discard(int(match.group(1)))
+            return None
+        return f"Error: Unrecognized command: {command}"
+
+    def blocks(self, numBlocks):
+        """Builds the next numBlocks waveform blocks for the enabled channels.
+        """
+        with self.__lock:
+            channels = sorted(self.enabled)
+        numFrames = numBlocks * self.framesPerBlock
+        blocks = np.zeros(numBlocks, dtype=waveformBlockDtype(self.framesPerBlock, len(channels)))
+        blocks['magic'] = MAGIC_NUMBER
+        # (blocks, frames) views; reshaping the strided frames field would copy it
+        frames = blocks['frames']
+        frames['timestamp'] = np.arange(self.timestamp, self.timestamp + numFrames).reshape(numBlocks, -1)
+        for i, channel in enumerate(channels):
+            microVolts = self.source.samples(channel, self.timestamp, numFrames)
+            frames['samples'][..., i] = np.clip(np.round(microVolts / 0.195) + 32768, 0, 65535).reshape(numBlocks, -1)
+        self.timestamp += numFrames
+        return blocks.tobytes()
+
+    def __serveCommands(self):
+        while not self.__closing:
+            try:
+                conn, addr = self.cmdServer.accept()
+            except OSError:
+                return
+            self.__debugOut(f"Command client {addr}")
+            with conn:
+                while True:
+                    try:
+                        message = conn.recv(4096)
+                    except OSError:
+                        break
+                    if not message:
+                        break
+                    replies = [self.handle(command) for command in str(message, 'utf-8').split(';') if command.strip()]
+                    replies = [reply for reply in replies if reply is not None]
+                    if replies:
+                        conn.sendall(bytes('\n'.join(replies), 'utf-8'))
+
+    def __serveWaveform(self):
+        while not self.__closing:
+            try:
+                conn, addr = self.waveServer.accept()
+            except OSError:
+                return
+            self.__debugOut(f"Waveform client {addr}")
+            with conn:
+                try:
+                    self.__stream(conn)
+                except OSError:
+                    pass
+
+    def __stream(self, conn):
+        blockTime = self.framesPerBlock / self.sampleRate
+        runStart, sentSinceStart = None, 0
+        while not self.__closing:
+            if not self.running or not self.enabled:
+                runStart = None
+                sleep(0.001)
+                continue
+            if runStart is None:
+                runStart, sentSinceStart = monotonic(), 0
+
+            # Blocks due by now at the requested speed
+            if self.speed is None:
+                due = 16
+            else:
+                due = int((monotonic() - runStart) * self.speed / blockTime) - sentSinceStart
+            if due <= 0:
+                sleep(min(blockTime / self.speed, 0.001))
+                continue
+
+            data = self.blocks(due)
+            conn.sendall(data)
+            sentSinceStart += due
+            self.blocksSent += due
+            self.bytesSent += len(data)
+
+    def __debugOut(self, *args):
+        if self.debug:
+            print("[DEBUG]", *args)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Local RHX TCP server simulator.')
+    parser.add_argument('--samplerate', type=float, default=10000)
+    parser.add_argument('--cmdport', type=int, default=5000)
+    parser.add_argument('--waveport', type=int, default=5001)
+    parser.add_argument('--speed', type=float, default=1, help='Playback speed; 0 = as fast as possible')
+    parser.add_argument('--recording', help='Replay the amplifier channels of this .rhd file')
+    parser.add_argument('--capture', help='Replay the channels of this stream capture directory')
+    args = parser.parse_args()
+
+    source, sampleRate = None, args.samplerate
+    if args.recording or args.capture:
+        if args.capture:
+            from streamcapture import CaptureReader
+            reader = CaptureReader(args.capture)
+        else:
+            from rhdreader import RHDReader
+            reader = RHDReader(args.recording)
+        source, sampleRate = SignalSource.fromRecording(reader), reader.sampleRate
+    simulator = RHXSimulator(source, sampleRate=sampleRate, cmdPort=args.cmdport, wavePort=args.waveport,
+                             speed=args.speed or None, debug=True).start()
+    print(f"Simulating RHX: commands on {simulator.cmdAddrPort}, waveform on {simulator.waveAddrPort}. Ctrl+C to quit.")
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        simulator.close()
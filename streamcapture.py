@@ -0,0 +1,220 @@
+#########################################
+#   Stream Capture
+#
+#   Records a live session for replay: the waveform bytes RHX sent are appended to disk
+#   exactly as received (no decoding) by a writer thread fed through a bounded queue,
+#   together with a sidecar index of block offsets and RHX timestamps and the decisions made.
+#   CaptureReader memory-maps the blocks and offers the RHDReader interface, so captures
+#   replay through rhdreader.RecordingSource, the RHX simulator and batchclassifier.
+#
+#   A capture is a directory (e.g. captures/20240101-120000.rhxcap) with:
+#     capture.json   sample rate, frames per block, channels
+#     blocks.bin     raw waveform blocks
+#     index.bin      per write: uint64 byte offset, uint32 blocks, int32 first frame timestamp
+#     decisions.bin  per decision: float64 timestamp, float32 feature and uint8 decision per channel
+#
+
+import os
+import json
+import threading
+import numpy as np
+from time import time, sleep
+from collections import deque
+from interfaceutils import waveformBlockDtype, toMicroVolts
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('blocks', '<u4'), ('timestamp', '<i4')])
+
+
+def decisionDtype(numChannels):
+    return np.dtype([('timestamp', '<f8'), ('power', '<f4', (numChannels,)), ('flex', 'u1', (numChannels,))])
+
+
+class CaptureWriter:
+    """Appends to a new capture directory from a writer thread, so acquisition and decisions
+    never wait for the disk. write() and writeDecision() only queue their data; when the
+    bounded queue is full (the disk stalled for `maxQueued` items) the data is dropped and
+    counted in self.dropped rather than blocking the caller. Replay sees dropped writes as
+    frame gaps.
+    Safe to close() while another thread writes (later writes are dropped).
+    """
+    def __init__(self, path, sampleRate, framesPerBlock=128, channels=(0,), maxQueued=1024, interval=0.01):
+        self.path = path
+        self.channels = list(channels)
+        self.blockSize = waveformBlockDtype(framesPerBlock, len(self.channels)).itemsize
+        os.makedirs(path)
+        with open(os.path.join(path, 'capture.json'), 'w') as file:
+            json.dump({'sampleRate': sampleRate, 'framesPerBlock': framesPerBlock, 'channels': self.channels,
+                       'createdAt': time()}, file, indent=1)
+        self.blocksFile = open(os.path.join(path, 'blocks.bin'), 'ab')
+        self.indexFile = open(os.path.join(path, 'index.bin'), 'ab')
+        self.decisionsFile = open(os.path.join(path, 'decisions.bin'), 'ab')
+        self.decisionDtype = decisionDtype(len(self.channels))
+        self.offset = 0
+        self.blocksWritten = 0
+        self.dropped = 0        # Writes and decisions lost to a full queue
+        self.closed = False
+        # deque.append/popleft are atomic, so producers take no lock and wake nothing; the
+        # writer thread polls every `interval` seconds
+        self.maxQueued = maxQueued
+        self.interval = interval
+        self.__queue = deque()
+        self.__writer = threading.Thread(target=self.__drain, daemon=True)
+        self.__writer.start()
+
+    def write(self, rawData):
+        """Queues whole waveform blocks (bytes or memoryview, as readAvailable returns them).
+        A read-only bytes object is queued as is; a memoryview or bytearray is copied, since
+        BlockReader reuses its receive buffer on the next read, before the disk write.
+        """
+        if self.closed or len(rawData) < self.blockSize:
+            return
+        self.__put(rawData if isinstance(rawData, bytes) else bytes(rawData))
+
+    def writeDecision(self, timestamp, power, flex):
+        """Queues one decision (RHX time in seconds, feature and decision per channel).
+        """
+        if not self.closed:
+            self.__put((timestamp, np.array(power), np.array(flex)))
+
+    def close(self):
+        """Writes out everything queued, then closes the files.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.__writer.join()
+        for file in (self.blocksFile, self.indexFile, self.decisionsFile):
+            file.close()
+
+    def __put(self, item):
+        if len(self.__queue) < self.maxQueued:
+            self.__queue.append(item)
+        else:
+            self.dropped += 1
+
+    def __drain(self):
+        while True:
+            closed = self.closed
+            while self.__queue:
+                item = self.__queue.popleft()
+                if isinstance(item, bytes):
+                    self.__writeBlocks(item)
+                else:
+                    self.decisionsFile.write(np.array(item, dtype=self.decisionDtype).tobytes())
+            # Flush whenever the queue runs dry, so a crash loses at most what was queued
+            for file in (self.blocksFile, self.indexFile, self.decisionsFile):
+                file.flush()
+            if closed:
+                return
+            sleep(self.interval)
+
+    def __writeBlocks(self, rawData):
+        numBlocks = len(rawData) // self.blockSize
+        # First frame's timestamp sits right after the block's magic number
+        timestamp = int.from_bytes(rawData[4:8], 'little', signed=True)
+        self.blocksFile.write(rawData)
+        self.indexFile.write(np.array((self.offset, numBlocks, timestamp), dtype=INDEX_DTYPE).tobytes())
+        self.offset += len(rawData)
+        self.blocksWritten += numBlocks
+
+
+class CaptureReader:
+    """Memory-mapped reader for a capture directory with the RHDReader interface
+    (sampleRate, timestep, numSamples, channelNames, timestamps, amplifier).
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'capture.json')) as file:
+            self.header = json.load(file)
+        self.sampleRate = self.header['sampleRate']
+        self.timestep = 1 / self.sampleRate
+        self.framesPerBlock = self.header['framesPerBlock']
+        self.channels = self.header['channels']
+        self.dtype = waveformBlockDtype(self.framesPerBlock, len(self.channels))
+
+        # A block cut short by a crash mid-write is ignored
+        self.numBlocks = os.path.getsize(os.path.join(path, 'blocks.bin')) // self.dtype.itemsize
+        self.numSamples = self.numBlocks * self.framesPerBlock
+        self.index = np.fromfile(os.path.join(path, 'index.bin'), dtype=INDEX_DTYPE)
+        self.__blocks = None
+
+    def blocks(self):
+        """Memory-mapped waveform blocks (nothing is read until fields are accessed).
+        """
+        if self.__blocks is None:
+            self.__blocks = np.memmap(os.path.join(self.path, 'blocks.bin'), dtype=self.dtype, mode='r',
+                                      shape=(self.numBlocks,)) if self.numBlocks else np.empty(0, self.dtype)
+        return self.__blocks
+
+    def channelNames(self):
+        return [f"A-%03.f" % channel for channel in self.channels]
+
+    def channelIndex(self, channel):
+        """Row of a channel given its native name ('A-023') or RHX channel number on port A (23).
+        Raises ValueError if the capture does not have the channel.
+        """
+        name = channel.upper() if isinstance(channel, str) else f"A-%03.f" % channel
+        names = self.channelNames()
+        if name not in names:
+            raise ValueError(f"Channel {name} is not in {self.path} (channels: {', '.join(names)}).")
+        return names.index(name)
+
+    def timestamps(self):
+        """Timestamps in seconds for every sample.
+        """
+        return self.blocks()['frames']['timestamp'].reshape(-1) * self.timestep
+
+    def amplifier(self, channel=None, row=None):
+        """Amplifier data of one channel in float32 microVolts. row: select by position among
+        the captured channels instead of by channel.
+        """
+        index = self.channelIndex(channel) if row is None else row
+        return toMicroVolts(self.blocks()['frames']['samples'][..., index].reshape(-1))
+
+    def blockAt(self, seconds):
+        """Index of the block holding RHX time `seconds` (timestamps increase within a capture).
+        Only the index and the blocks of one write are read.
+        """
+        frame = round(seconds / self.timestep)
+        written = np.searchsorted(self.index['timestamp'], frame, side='right') - 1
+        if written < 0:
+            return 0
+        first = int(self.index['offset'][written]) // self.dtype.itemsize
+        count = int(self.index['blocks'][written])
+        starts = self.blocks()['frames']['timestamp'][first:first + count, 0]
+        return min(first + max(0, np.searchsorted(starts, frame, side='right') - 1), self.numBlocks - 1)
+
+    def read(self, start, seconds):
+        """(timestamps, data) from RHX time `start` for `seconds`: data is 1-D for one channel,
+        (channels, samples) otherwise, as IntanInterface.readWaveform returns it.
+        """
+        first = self.blockAt(start)
+        numFrames = round(seconds / self.timestep)
+        blocks = self.blocks()[first:first + -(-numFrames // self.framesPerBlock) + 1]
+        frames = blocks['frames'].reshape(-1)
+        skip = int(np.searchsorted(frames['timestamp'], round(start / self.timestep)))
+        frames = frames[skip:skip + numFrames]
+        data = toMicroVolts(frames['samples'].T)
+        return frames['timestamp'] * self.timestep, data[0] if len(self.channels) == 1 else data
+
+    def decisions(self):
+        """Structured array of the recorded decisions (timestamp, power, flex).
+        """
+        return np.fromfile(os.path.join(self.path, 'decisions.bin'), dtype=decisionDtype(len(self.channels)))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize a stream capture.')
+    parser.add_argument('capture', help='Capture directory')
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.capture)
+    timestamps = reader.timestamps()
+    decisions = reader.decisions()
+    print(f"{args.capture}: {reader.numBlocks} blocks, {reader.numSamples / reader.sampleRate:.2f}s at "
+          f"{reader.sampleRate:g} Hz, channels {', '.join(reader.channelNames())}")
+    if len(timestamps):
+        print(f"  RHX time {timestamps[0]:.3f}s to {timestamps[-1]:.3f}s in {len(reader.index)} writes")
+    if len(decisions):
+        print(f"  {len(decisions)} decisions, {np.mean(decisions['flex'], axis=0)} flexing")
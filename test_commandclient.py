@@ -0,0 +1,63 @@
+import socket
+import threading
+import pytest
+from commandclient import CommandClient, frameReplies
+from interfaceutils import CommandError
+
+
+def test_frame_waits_for_closing_return():
+    assert frameReplies('', 1) is None
+    assert frameReplies('Return: SampleRateHertz 30', 1) is None
+    assert frameReplies('Return: SampleRateHertz 30000\nReturn: RunMode Re', 1) is None
+    replies, mode, rest = frameReplies('Return: SampleRateHertz 30000\nReturn: RunMode Record\nReturn: X', 1)
+    assert replies == ['Return: SampleRateHertz 30000'] and mode == 'Record' and rest == 'Return: X'
+
+
+def test_frame_skips_queried_runmode():
+    text = 'Return: RunMode Run\nReturn: SampleRateHertz 20000\nReturn: RunMode Run'
+    assert frameReplies(text[:text.rindex('Return')], 2) is None
+    replies, mode, rest = frameReplies(text, 2)
+    assert replies == ['Return: RunMode Run', 'Return: SampleRateHertz 20000']
+
+
+def test_frame_collects_errors():
+    replies, mode, rest = frameReplies('Error: Unrecognized command: set x\nReturn: RunMode Stop', 0)
+    assert replies == ['Error: Unrecognized command: set x'] and mode == 'Stop' and rest == ''
+
+
+def serve(chunks):
+    """Connected client socket whose peer answers the first request with `chunks`, one send each."""
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(listener.getsockname())
+    server, address = listener.accept()
+    listener.close()
+
+    def reply():
+        server.recv(4096)
+        for chunk in chunks:
+            server.sendall(chunk.encode())
+            threading.Event().wait(0.02)
+    threading.Thread(target=reply, daemon=True).start()
+    return server, client
+
+
+def test_split_reply_is_not_truncated():
+    server, client = serve(['Return: RunMode Stop\nReturn: SampleRateHertz 30', '000', '\nReturn: Run', 'Mode Stop'])
+    client.settimeout(5)
+    commands = CommandClient(client, timeout=2)
+    assert commands.query('runmode', 'sampleratehertz') == {'runmode': 'Stop', 'sampleratehertz': '30000'}
+    assert client.gettimeout() == 5
+    server.close()
+    client.close()
+
+
+def test_execute_errors_and_timeout():
+    server, client = serve(['Error: TCP data output cannot be changed while running\n', 'Return: RunMode Run'])
+    commands = CommandClient(client, timeout=2)
+    with pytest.raises(CommandError):
+        commands.execute('set a-000.tcpdataoutputenabled true')
+    with pytest.raises(TimeoutError):
+        commands.execute('set runmode stop', timeout=0.1)
+    assert client.gettimeout() is None
+    server.close()
+    client.close()
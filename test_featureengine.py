@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+import pywt
+from featureengine import FocusScaleCWT, Decimator, SlidingPower, autoDecimation, makeExtractor
+
+SCALES = np.arange(1, 128, 4)
+
+
+def emg(n, seed=0):
+    return 0.195 * (np.random.default_rng(seed).integers(0, 65536, n) - 32768)
+
+
+@pytest.mark.parametrize('wavelet', ['mexh', 'morl'])
+@pytest.mark.parametrize('method', ['conv', 'fft', 'auto'])
+@pytest.mark.parametrize('focusfreq', [0, 6, 25])
+def test_compute_matches_pywt(wavelet, method, focusfreq):
+    data = emg(2500)
+    coef, freq = pywt.cwt(data, SCALES, wavelet, method='conv' if method == 'auto' else method)
+    row = FocusScaleCWT(wavelet, SCALES[focusfreq], method=method).compute(data)
+    assert row.shape == data.shape
+    np.testing.assert_allclose(row, coef[focusfreq], rtol=0, atol=1e-10 * np.max(np.abs(coef[focusfreq])))
+
+
+def test_compute_rows():
+    data = np.stack([emg(1000, seed) for seed in range(3)])
+    engine = FocusScaleCWT('mexh', SCALES[25])
+    rows = engine.compute(data)
+    for row, channel in zip(rows, data):
+        np.testing.assert_allclose(row, engine.compute(channel), rtol=1e-12, atol=1e-9)
+
+
+@pytest.mark.parametrize('wavelet', ['mexh', 'morl'])
+@pytest.mark.parametrize('chunk', [1, 37, 400, 5000])
+def test_stream_matches_pywt(wavelet, chunk):
+    data = emg(3000)
+    coef, freq = pywt.cwt(data, SCALES, wavelet)
+    engine = FocusScaleCWT(wavelet, SCALES[25])
+    state = engine.initialState()
+    out = []
+    for start in range(0, len(data), chunk):
+        powers, state = engine.stream(data[start:start + chunk], state)
+        out.append(powers)
+    out = np.concatenate(out)
+    # The stream lags by the kernel offset; the rest is |coef| of the batch transform
+    assert len(out) == len(data) - engine.delay
+    expected = np.abs(coef[25][:len(out)])
+    np.testing.assert_allclose(out, expected, rtol=0, atol=1e-10 * np.max(expected))
+
+
+def pushRandomChunks(sliding, data, seed=0):
+    rng = np.random.default_rng(seed)
+    indices, values = [], []
+    start = 0
+    while start < data.shape[-1]:
+        chunk = int(rng.integers(1, 700))
+        emitted, means = sliding.push(data[..., start:start + chunk])
+        indices.append(emitted)
+        values.append(means)
+        start += chunk
+    return np.concatenate(indices), np.concatenate(values, axis=-1)
+
+
+@pytest.mark.parametrize('feature', ['cwt', 'rms', 'bandpower', 'teager'])
+@pytest.mark.parametrize('window, hop', [(500, 100), (1000, 333), (64, 1)])
+def test_sliding_matches_batch(feature, window, hop):
+    data = emg(6000, seed=1)
+    engine = makeExtractor(feature, 30000, wavelet='mexh', scale=SCALES[25])
+    indices, values = pushRandomChunks(SlidingPower(engine, window, hop), data)
+    # Every hop-th window that ends before the last `delay` samples, each the batch mean power
+    # of the whole stream's sample powers over that window
+    expected = np.arange(window - 1, len(data) - engine.delay)
+    np.testing.assert_array_equal(indices, expected[(expected + 1) % hop == 0])
+    powers = engine.samplePowers(data)
+    for index, value in zip(indices, values):
+        batch = engine.finish(np.mean(powers[index - window + 1:index + 1]))
+        np.testing.assert_allclose(value, batch, rtol=1e-9)
+
+
+def test_sliding_matches_window_mean_power():
+    # Without filter or kernel state the stream equals meanPower of each window itself
+    data = emg(6000, seed=2)
+    engine = makeExtractor('rms', 30000)
+    indices, values = pushRandomChunks(SlidingPower(engine, 750, 250), data)
+    assert len(indices)
+    for index, value in zip(indices, values):
+        np.testing.assert_allclose(value, engine.meanPower(data[index - 749:index + 1]), rtol=1e-9)
+
+
+def test_sliding_channels():
+    data = np.stack([emg(4000, seed) for seed in range(3)])
+    engine = makeExtractor('cwt', 30000, wavelet='mexh', scale=SCALES[[10, 20, 25]])
+    indices, values = pushRandomChunks(SlidingPower(engine, 800, 200, numChannels=3), data)
+    assert values.shape == (3, len(indices))
+    powers = engine.samplePowers(data)
+    for column, index in enumerate(indices):
+        batch = engine.finish(np.mean(powers[:, index - 799:index + 1], axis=-1))
+        np.testing.assert_allclose(values[:, column], batch, rtol=1e-9)
+
+
+def test_auto_decimation_per_feature():
+    assert autoDecimation('cwt', 30000, scale=SCALES[[20, 25]]) == SCALES[20] // 8
+    q = autoDecimation('bandpower', 30000, band=(20, 450))
+    assert q == 13
+    # The band stays in the lower half of the decimator's passband
+    assert 450 <= 0.5 * 0.8 * 30000 / (2 * q) < 450 * (q + 1) / q
+    assert autoDecimation('bandpower', 30000, band=(20, 5000)) == 1
+    for feature in ('rms', 'teager'):
+        with pytest.raises(ValueError):
+            autoDecimation(feature, 30000)
+
+
+def test_auto_decimated_bandpower_matches():
+    # Same band power (up to the filters' edges) at the decimated rate
+    rng = np.random.default_rng(3)
+    t = np.arange(30000) / 30000
+    data = np.sin(2 * np.pi * 150 * t) + 0.1 * rng.standard_normal(t.size)
+    q = autoDecimation('bandpower', 30000)
+    full = makeExtractor('bandpower', 30000).meanPower(data)
+    decimated = makeExtractor('bandpower', 30000, q).meanPower(Decimator(q).decimate(data))
+    np.testing.assert_allclose(decimated, full, rtol=0.05)
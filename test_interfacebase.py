@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from interfacebase import IntanInterfaceBase
+
+
+def calibrated(tmp_path, **setup):
+    interface = IntanInterfaceBase()
+    interface.profileDir = str(tmp_path)
+    interface.applySetup({'channel': 23, 'focusfreq': 25, **setup})
+    interface.timestep = 1 / 30000
+    interface.buildFeatureEngine()
+    interface.setThreshold({'Resting': 10.0, 'Flexing': 30.0})
+    return interface
+
+
+def test_profile_round_trip(tmp_path):
+    calibrated(tmp_path).saveProfile('right')
+    interface = calibrated(tmp_path)
+    interface.restingPower = interface.flexingPower = interface.flexThresh = None
+    profile = interface.loadProfile('right')
+    # Read only: nothing is applied until the caller validated it
+    assert interface.flexThresh is None
+    assert interface.matchesProfile(11.0, profile) and not interface.matchesProfile(20.0, profile)
+    interface.applyProfile(profile)
+    assert (interface.restingPower, interface.flexingPower, interface.flexThresh) == (10.0, 30.0, 25.0)
+
+
+@pytest.mark.parametrize('setup', [dict(feature='rms'), dict(decimation=2), dict(focusfreq=20),
+                                   dict(feature='bandpower', featureoptions={'band': (20, 450)})])
+def test_profile_with_other_settings_rejected(tmp_path, setup):
+    calibrated(tmp_path).saveProfile()
+    interface = calibrated(tmp_path, **setup)
+    before = interface.profileSettings()
+    assert interface.loadProfile() is None
+    assert interface.profileSettings() == before
+
+
+def test_profile_feature_options_compared_as_saved(tmp_path):
+    options = {'band': (20, 450)}
+    calibrated(tmp_path, feature='bandpower', featureoptions=options).saveProfile()
+    assert calibrated(tmp_path, feature='bandpower', featureoptions=options).loadProfile() is not None
+
+
+def test_profile_other_rate_or_age_rejected(tmp_path):
+    calibrated(tmp_path).saveProfile()
+    interface = calibrated(tmp_path)
+    interface.timestep = 1 / 20000
+    assert interface.loadProfile() is None
+    assert calibrated(tmp_path).loadProfile(maxage=-1) is None
+    assert calibrated(tmp_path).loadProfile(maxage=60) is not None
+
+
+@pytest.mark.parametrize('feature, decimation', [('cwt', 12), ('bandpower', 13)])
+def test_auto_decimation_follows_feature(tmp_path, feature, decimation):
+    assert calibrated(tmp_path, feature=feature, decimation='auto').decimation == decimation
+
+
+def test_auto_decimation_rejected_without_band(tmp_path):
+    with pytest.raises(ValueError):
+        calibrated(tmp_path, feature='rms', decimation='auto')
+
+
+def test_focusfreq_follows_channel_sort(tmp_path):
+    interface = calibrated(tmp_path, channel=[23, 5, 12], focusfreq=[25, 10, 20])
+    assert interface.getChannels() == [5, 12, 23]
+    assert interface.focusfreq == [10, 20, 25]
+    np.testing.assert_array_equal(interface.featureEngine.scales, interface.scales[[10, 20, 25]])
+    with pytest.raises(ValueError):
+        calibrated(tmp_path, channel=[23, 5], focusfreq=[25])
@@ -0,0 +1,77 @@
+import socket
+import numpy as np
+import pytest
+from time import perf_counter
+from interfaceutils import (MAGIC_NUMBER, InvalidMagicNumber, InvalidReceivedDataSize, BlockReader, waveformBlockDtype,
+                            decodeWaveformBlocks, decodeWaveformBlocksReference)
+
+TIMESTEP = 1 / 30000
+
+
+def syntheticBlocks(numBlocks, framesPerBlock=128, seed=0):
+    rng = np.random.default_rng(seed)
+    blocks = np.zeros(numBlocks, dtype=waveformBlockDtype(framesPerBlock))
+    blocks['magic'] = MAGIC_NUMBER
+    blocks['frames']['timestamp'] = np.arange(1000, 1000 + numBlocks * framesPerBlock).reshape(numBlocks, -1)
+    blocks['frames']['samples'] = rng.integers(0, 65536, blocks['frames']['samples'].shape)
+    return blocks
+
+
+@pytest.mark.parametrize('framesPerBlock', [128, 60])
+def test_decoders_identical(framesPerBlock):
+    rawData = syntheticBlocks(10, framesPerBlock).tobytes()
+    timestamps, data = decodeWaveformBlocks(rawData, TIMESTEP, framesPerBlock, dtype=np.float64)
+    refTimestamps, refData = decodeWaveformBlocksReference(rawData, TIMESTEP, framesPerBlock)
+    assert data.dtype == refData.dtype == np.float64
+    np.testing.assert_array_equal(timestamps, refTimestamps)
+    np.testing.assert_array_equal(data, refData)
+
+
+def test_default_dtype_matches_reference():
+    rawData = syntheticBlocks(3).tobytes()
+    np.testing.assert_array_equal(decodeWaveformBlocks(rawData, TIMESTEP)[1],
+                                  decodeWaveformBlocksReference(rawData, TIMESTEP)[1])
+
+
+def test_bad_magic_number():
+    blocks = syntheticBlocks(4)
+    blocks['magic'][2] = 0xdeadbeef
+    for decode in (decodeWaveformBlocks, decodeWaveformBlocksReference):
+        with pytest.raises(InvalidMagicNumber):
+            decode(blocks.tobytes(), TIMESTEP)
+
+
+def test_partial_block():
+    rawData = syntheticBlocks(2).tobytes()[:-2]
+    for decode in (decodeWaveformBlocks, decodeWaveformBlocksReference):
+        with pytest.raises(InvalidReceivedDataSize):
+            decode(rawData, TIMESTEP)
+
+
+def test_read_available_timeout_keeps_partial_block():
+    rawData = syntheticBlocks(2).tobytes()
+    blockSize = len(rawData) // 2
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        reader = BlockReader(receiver, blockSize)
+        start = perf_counter()
+        assert len(reader.readAvailable(timeout=0.05)) == 0
+        assert perf_counter() - start < 1
+        sender.sendall(rawData[:blockSize + 10])
+        assert bytes(reader.readAvailable(timeout=0.05)) == rawData[:blockSize]
+        assert len(reader.readAvailable(timeout=0.05)) == 0 and reader.pending() == 10
+        sender.sendall(rawData[blockSize + 10:])
+        assert bytes(reader.readAvailable(timeout=0.05)) == rawData[blockSize:]
+
+
+def test_discard_drops_previous_run():
+    rawData = syntheticBlocks(3).tobytes()
+    blockSize = len(rawData) // 3
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        reader = BlockReader(receiver, blockSize)
+        sender.sendall(rawData[:2 * blockSize])
+        assert bytes(reader.readBlocks(1)) == rawData[:blockSize]
+        assert reader.discard() == blockSize
+        sender.sendall(rawData[2 * blockSize:])
+        assert bytes(reader.readBlocks(1)) == rawData[2 * blockSize:]